@@ -1,21 +1,101 @@
+import hashlib
+import os
+from datetime import timedelta
+
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import object_session
+from sqlalchemy.sql import func
+
+from idetect.model import Relevance, Status, ClassificationCache
 
 
 '''Method(s) for running classifier on extracted content.
 '''
 
-def classify(analysis, category_model, relevance_model):
+# When set, articles classified as not relevant are not sent to fact extraction
+SKIP_IRRELEVANT_EXTRACTION = os.environ.get('SKIP_IRRELEVANT_EXTRACTION', 'False').lower() == 'true'
+# Days after which cached results of other versions of the models are deleted
+CLASSIFICATION_CACHE_TTL_DAYS = int(os.environ.get('CLASSIFICATION_CACHE_TTL_DAYS', '30'))
+
+
+def classify(analysis, category_model, relevance_model, prefilter=None):
     """
     Tag and categorize analysis using its content.
+    Results are looked up first in the classification cache, keyed by the content
+    and the versions of the models.
     
     :params analysis: An Analysis instance
+    :params prefilter: optional LexiconPrefilter; articles it rejects are
+        marked not relevant without running the relevance model
     :return: None
     """
     session = object_session(analysis)
     content = analysis.content.content
-    category = category_model.predict(content)
     content_clean = analysis.content.content_clean
-    relevance = relevance_model.predict(content_clean)
+    key = content_hash(content, content_clean)
+    version = model_version(category_model, relevance_model)
+    cached = session.query(ClassificationCache).get((key, version))
+    if cached:
+        analysis.category = cached.category
+        analysis.relevance = cached.relevance
+        session.commit()
+        return
+
+    category = category_model.predict(content)
+    candidate = True
+    if prefilter is not None:
+        candidate = prefilter.is_candidate(content_clean)
+    if candidate or prefilter.should_audit():
+        relevance = relevance_model.predict(content_clean)
+        if prefilter is not None:
+            prefilter.record(candidate, relevance)
+        # Only the models' own results are cached, not those of the prefilter.
+        # The version is read again in case the inference service was restarted meanwhile.
+        session.execute(insert(ClassificationCache.__table__).values(
+            content_hash=key, model_version=model_version(category_model, relevance_model), category=category, relevance=relevance
+        ).on_conflict_do_nothing())
+    else:
+        relevance = Relevance.NOT_DISPLACEMENT
     analysis.category = category
     analysis.relevance = relevance
     session.commit()
+
+
+def content_hash(content, content_clean):
+    '''Hash of the texts used by the category and relevance models'''
+    digest = hashlib.sha256()
+    for text in (content, content_clean):
+        digest.update((text or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def model_version(category_model, relevance_model):
+    '''Version of the pair of models, changes when either model file is replaced'''
+    return '{}/{}'.format(category_model.version, relevance_model.version)
+
+
+def purge_classification_cache(session, version):
+    '''Delete cached results of other versions of the models that are older than
+    CLASSIFICATION_CACHE_TTL_DAYS. Recent ones are kept, as workers still running
+    the other versions, e.g. during a rolling deploy, may use them.
+    '''
+    deleted = session.query(ClassificationCache) \
+        .filter(ClassificationCache.model_version != version,
+                ClassificationCache.created < func.now() - timedelta(days=CLASSIFICATION_CACHE_TTL_DAYS)) \
+        .delete(synchronize_session=False)
+    session.commit()
+    return deleted
+
+
+def classified_status(analysis):
+    """
+    Status of an analysis once it is classified. Articles that are not relevant
+    end in NOT_RELEVANT when SKIP_IRRELEVANT_EXTRACTION is set, and go on to
+    fact extraction otherwise.
+    :params analysis: An Analysis instance
+    :return: String
+    """
+    if SKIP_IRRELEVANT_EXTRACTION and analysis.relevance == Relevance.NOT_DISPLACEMENT:
+        return Status.NOT_RELEVANT
+    return Status.CLASSIFIED
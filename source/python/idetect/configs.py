@@ -29,11 +29,12 @@ logger = get_logger(__name__)
 
 
 class Command():
-    def __init__(self, name, args, is_initiator=False, kwargs={}):
+    def __init__(self, name, args, is_initiator=False, kwargs={}, worker_class=None):
         self.name = name
         self.args = args
         self.kwargs = kwargs
         self.is_initiator = is_initiator
+        self.worker_class = worker_class or (Worker if not is_initiator else Initiator)
 
         # Setup db engine
         engine = create_engine(db_url())
@@ -42,7 +43,7 @@ class Command():
         self.engine = engine
 
     def _run(self, is_single_run=False):
-        worker = (Worker if not self.is_initiator else Initiator)(*self.args, self.engine, **self.kwargs)
+        worker = self.worker_class(*self.args, self.engine, **self.kwargs)
         if is_single_run:
             logger.info(f"Starting worker ({self.name})...")
             worker.work_all()
@@ -3,17 +3,62 @@
 How to ensure has access to pre-loaded models?
 '''
 import json
+import logging
+import os
+import time
+from collections import OrderedDict
 
-import spacy
 from itertools import groupby
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import object_session
 from sqlalchemy.exc import IntegrityError
 
-from idetect.interpreter import Interpreter
-from idetect.model import Fact, Location, Country
+from idetect.interpreter import Interpreter, keywords_version
+from idetect.language import get_nlp
+from idetect.model import Fact, Location, Country, analysis_fact, fact_location
+from idetect.parse_cache import get_parse, get_parses, LONG_TEXT_LENGTH
+from idetect.profiling import Profiler
 
-nlp = spacy.load("en_default")
-print("Loaded Spacy English Language NLP Models.")
+logger = logging.getLogger(__name__)
+
+# When set, the time spent in the main steps of the extraction is logged for each article
+PROFILE_EXTRACTION = os.environ.get('PROFILE_EXTRACTION', 'False').lower() == 'true'
+# Interpreter methods timed when profiling
+PROFILED_METHODS = ('process_sentence_new', 'extract_locations', 'get_subjects_and_objects',
+                    'get_quantity', 'convert_term')
+
+# Contents longer than this many characters are parsed in chunks of
+# EXTRACTION_CHUNK_SIZE characters, and their parse is not stored
+CHUNKED_EXTRACTION_LENGTH = LONG_TEXT_LENGTH
+EXTRACTION_CHUNK_SIZE = 20000
+
+# Number of location names whose id is kept in memory by each process
+LOCATION_CACHE_SIZE = 10000
+
+# Location name to id, for locations known to be committed, least recently used first
+_location_ids = OrderedDict()
+
+# Interpreter of this process, and the version of the keywords it was built with
+_interpreter = None
+_interpreter_keywords = None
+profiler = Profiler() if PROFILE_EXTRACTION else None
+
+
+def get_interpreter(session, nlp):
+    '''Return the Interpreter of this process, building it again if the keywords have changed
+    :params session: session used to load the keywords
+    :params nlp: a spaCy Language instance
+    :return: instance of Interpreter
+    '''
+    global _interpreter, _interpreter_keywords
+    version = keywords_version(session)
+    if _interpreter is None or _interpreter.nlp is not nlp or version != _interpreter_keywords:
+        _interpreter = Interpreter(session, nlp)
+        _interpreter_keywords = version
+        if profiler is not None:
+            profiler.wrap(_interpreter, PROFILED_METHODS)
+    return _interpreter
 
 
 def extract_facts(analysis):
@@ -22,33 +67,187 @@ def extract_facts(analysis):
     :return: None
     '''
     session = object_session(analysis)
-    interpreter = Interpreter(session, nlp)
-    content = analysis.content.content_clean # Use the cleaned content field
-    facts = interpreter.process_article_new(content)
+    nlp = get_nlp('extraction')
+    interpreter = get_interpreter(session, nlp)
+    if profiler is not None:
+        profiler.start_article()
+    if is_long(analysis.content):
+        facts = interpreter.process_article_chunked(analysis.content.content_clean, EXTRACTION_CHUNK_SIZE)
+    else:
+        parse = get_parse if profiler is None else profiler.timed('parse', get_parse)
+        story = parse(analysis.content, nlp) # Use the cleaned content field
+        facts = interpreter.process_article_new(story)
+    if profiler is not None:
+        logger.info("Extraction profile of Analysis {}: {}".format(
+            analysis.gkg_id, profiler.report(profiler.end_article())))
     if len(facts) > 0:
         save_facts(analysis, facts, session)
 
 
+def extract_facts_batch(analyses, batch_size=16, n_threads=1):
+    '''Extract facts for a batch of Analyses, parsing their contents together
+    with nlp.pipe, and save all the facts in one transaction
+    :params analyses: list of Analysis instances from the same session
+    :params batch_size: number of texts buffered by nlp.pipe
+    :params n_threads: number of threads used by nlp.pipe
+    :return: dict of the Analyses that failed to the exception raised for each
+    '''
+    session = object_session(analyses[0])
+    nlp = get_nlp('extraction')
+    interpreter = get_interpreter(session, nlp)
+    short = [analysis for analysis in analyses if not is_long(analysis.content)]
+    start = time.time()
+    stories = dict(zip(short, get_parses([analysis.content for analysis in short], nlp, batch_size, n_threads)))
+    # The texts are parsed together, each article is profiled with an equal share of the time
+    parse_share = (time.time() - start) / max(len(short), 1)
+    failures = {}
+    location_ids = {}
+    for analysis in analyses:
+        if profiler is not None:
+            profiler.start_article()
+            if analysis in stories:
+                profiler.record('parse', parse_share)
+        savepoint = session.begin_nested()
+        try:
+            if analysis in stories:
+                facts = interpreter.process_article_new(stories[analysis])
+            else:
+                facts = interpreter.process_article_chunked(analysis.content.content_clean, EXTRACTION_CHUNK_SIZE)
+            if profiler is not None:
+                logger.info("Extraction profile of Analysis {}: {}".format(
+                    analysis.gkg_id, profiler.report(profiler.end_article())))
+            ids = add_facts(analysis, facts, session)
+            savepoint.commit()
+            location_ids.update(ids)
+        except Exception as e:
+            savepoint.rollback()
+            if isinstance(e, IntegrityError):
+                clear_location_cache()
+            failures[analysis] = e
+    session.commit()
+    remember_location_ids(location_ids)
+    return failures
+
+
+def is_long(content):
+    '''Whether a content is long enough to be processed in chunks
+    :params content: instance of DocumentContent
+    :return: Boolean
+    '''
+    return len(content.content_clean or '') > CHUNKED_EXTRACTION_LENGTH
+
+
 def save_facts(analysis, facts, session):
-    '''Loop through extracted facts and save them to database
+    '''Save extracted facts, their locations and the links between them to database in one transaction
     :params article: instance of Article
     :params facts: list of extracted facts
     :params session: session object corresponding to the article
     :return: None
     '''
-    for f in facts:
-        fact = Fact(unit=f.reporting_unit, term=f.reporting_term,
-                    excerpt_start=f.sentence_start, excerpt_end=f.sentence_end,
-                    specific_reported_figure=f.quantity[0],
-                    vague_reported_figure=f.quantity[1],
-                    tag_locations=json.dumps(f.tag_spans))
-        session.add(fact)
-        analysis.facts.append(fact)
-
-        # Process the locations and add new ones to the locations table
-        locations = { process_location(location, session) for location in f.locations }
-        fact.locations.extend(locations)
+    try:
+        location_ids = add_facts(analysis, facts, session)
         session.commit()
+    except IntegrityError:
+        # a cached location may have been deleted
+        clear_location_cache()
+        raise
+    remember_location_ids(location_ids)
+
+
+def add_facts(analysis, facts, session):
+    '''Insert extracted facts, new locations and the links between them
+    with multi-row inserts, leaving the caller to commit
+    :params analysis: instance of Analysis
+    :params facts: list of extracted facts
+    :params session: session object corresponding to the analysis
+    :return: dict of the names of the facts' locations to their ids
+    '''
+    if len(facts) == 0:
+        return {}
+    # Allocate the ids up front so that the links can be inserted in bulk as well
+    fact_ids = Fact.allocate_ids(session, len(facts))
+    session.execute(Fact.__table__.insert().values([
+        dict(id=fact_id, unit=f.reporting_unit, term=f.reporting_term,
+             excerpt_start=f.sentence_start, excerpt_end=f.sentence_end,
+             specific_reported_figure=f.quantity[0],
+             vague_reported_figure=f.quantity[1],
+             tag_locations=json.dumps(f.tag_spans))
+        for fact_id, f in zip(fact_ids, facts)
+    ]))
+    session.execute(analysis_fact.insert().values([
+        {'analysis': analysis.gkg_id, 'fact': fact_id} for fact_id in fact_ids
+    ]))
+
+    # Add new locations to the locations table
+    location_ids = get_location_ids(session, {location for f in facts for location in f.locations})
+    links = [{'fact': fact_id, 'location': location_id}
+             for fact_id, f in zip(fact_ids, facts)
+             for location_id in {location_ids[location] for location in f.locations}]
+    if links:
+        session.execute(fact_location.insert().values(links))
+    return location_ids
+
+
+def get_location_ids(session, location_names):
+    '''Return the ids of the locations with the given names, adding the ones that do not exist
+    :params session: session object
+    :params location_names: set of location names
+    :return: dict of location name to id
+    '''
+    location_ids = {}
+    for name in location_names:
+        if name in _location_ids:
+            _location_ids.move_to_end(name)
+            location_ids[name] = _location_ids[name]
+    unknown = location_names - location_ids.keys()
+    if not unknown:
+        return location_ids
+    location_ids.update(session.query(Location.location_name, Location.id)
+                        .filter(Location.location_name.in_(unknown)))
+    missing = sorted(unknown - location_ids.keys())
+    if missing:
+        inserted = session.execute(
+            insert(Location.__table__).values([{'location_name': name} for name in missing])
+            .on_conflict_do_nothing(index_elements=['location_name'])
+            .returning(Location.__table__.c.location_name, Location.__table__.c.id))
+        location_ids.update(dict(inserted.fetchall()))
+        # Locations added by another worker in the meantime
+        concurrent = [name for name in missing if name not in location_ids]
+        if concurrent:
+            location_ids.update(session.query(Location.location_name, Location.id)
+                                .filter(Location.location_name.in_(concurrent)))
+    return location_ids
+
+
+def remember_location_ids(location_ids):
+    '''Keep the ids of committed locations in memory, dropping the least recently used ones
+    :params location_ids: dict of location name to id
+    :return: None
+    '''
+    for name, location_id in location_ids.items():
+        _location_ids[name] = location_id
+        _location_ids.move_to_end(name)
+    while len(_location_ids) > LOCATION_CACHE_SIZE:
+        _location_ids.popitem(last=False)
+
+
+def clear_location_cache():
+    _location_ids.clear()
+
+
+def warm_location_cache(session, limit=LOCATION_CACHE_SIZE):
+    '''Fill the location cache with the locations linked to the most facts
+    :params session: session object
+    :params limit: number of locations to load
+    :return: None
+    '''
+    rows = session.query(Location.location_name, Location.id) \
+        .join(fact_location, fact_location.c.location == Location.id) \
+        .group_by(Location.id) \
+        .order_by(func.count().desc()) \
+        .limit(limit).all()
+    # the most frequent locations are added last, so they are dropped last
+    remember_location_ids(OrderedDict(reversed(rows)))
 
 
 def process_location(location_name, session):
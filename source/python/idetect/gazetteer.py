@@ -0,0 +1,130 @@
+'''Indexes of country and subdivision names for fast lookups.
+
+Matching a place name used to scan all of pycountry.countries and
+pycountry.subdivisions, normalizing every name on each comparison. The indexes
+below are built once per process, the first time they are needed, and map the
+names to the countries directly.
+
+Besides the pycountry names, the country names, official names and common
+names of all_countries.csv (the source of idetect_country_terms) are indexed,
+along with the centroid of each country.
+'''
+import csv
+import logging
+import os
+import unicodedata
+from functools import lru_cache
+
+import pycountry
+
+logger = logging.getLogger(__name__)
+
+COUNTRIES_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'all_countries.csv')
+
+
+def normalize(name):
+    '''Strip out accents and lower case a name, as in geotagger.compare_strings'''
+    return ''.join(c for c in unicodedata.normalize('NFD', name) if unicodedata.category(c) != 'Mn').lower()
+
+
+@lru_cache(maxsize=None)
+def country_rows():
+    '''Return the rows of all_countries.csv, or no rows if it is missing'''
+    try:
+        with open(COUNTRIES_CSV, encoding='utf-8') as f:
+            return list(csv.DictReader(f))
+    except FileNotFoundError:
+        logger.warning("{} not found, matching countries on pycountry names only".format(COUNTRIES_CSV))
+        return []
+
+
+@lru_cache(maxsize=None)
+def country_index():
+    '''Map the name, common name and official name of each country to its
+    alpha_3 code and name. If several countries share a name, the first one wins.
+    '''
+    index = {}
+    for country in pycountry.countries:
+        index.setdefault(country.name, (country.alpha_3, country.name))
+        if hasattr(country, 'common_name'):
+            index.setdefault(country.common_name, (country.alpha_3, country.common_name))
+        if hasattr(country, 'official_name'):
+            index.setdefault(country.official_name, (country.alpha_3, country.name))
+    return index
+
+
+@lru_cache(maxsize=None)
+def country_alias_index():
+    '''Map the normalized names of country_index and the names of
+    all_countries.csv to the alpha_3 code and name of the country.
+    '''
+    index = {}
+    for name, country in country_index().items():
+        index.setdefault(normalize(name), country)
+    for row in country_rows():
+        for column in ('country_name', 'common_name', 'official_name'):
+            if row[column]:
+                index.setdefault(normalize(row[column]), (row['code_3'], row['country_name']))
+    return index
+
+
+@lru_cache(maxsize=None)
+def country_centroids():
+    '''Map the alpha_3 code of each country of all_countries.csv to its "lat,long" centroid'''
+    return {row['code_3']: row['latlong'] for row in country_rows() if row['latlong']}
+
+
+@lru_cache(maxsize=None)
+def subdivision_index():
+    '''Map the normalized name of each subdivision to the alpha_3 code and name
+    of its country. If several subdivisions share a name, the first one wins.
+    '''
+    countries = {c.alpha_2: (c.alpha_3, c.name) for c in pycountry.countries}
+    index = {}
+    for subdivision in pycountry.subdivisions:
+        index.setdefault(normalize(subdivision.name), countries[subdivision.country_code])
+    return index
+
+
+@lru_cache(maxsize=None)
+def alpha_3_index():
+    '''Map the alpha_2 code of each country to its alpha_3 code'''
+    return {c.alpha_2: c.alpha_3 for c in pycountry.countries}
+
+
+@lru_cache(maxsize=None)
+def alpha_2_index():
+    '''Map the alpha_3 code of each country to its alpha_2 code'''
+    return {c.alpha_3: c.alpha_2 for c in pycountry.countries}
+
+
+def match_country(place_name, exact=False):
+    '''Return the alpha_3 code and name of the country with this name,
+    or None, None if there is none. Unless exact is set, accents and case are
+    ignored and the names of all_countries.csv are matched as well.
+    '''
+    if exact:
+        return country_index().get(place_name, (None, None))
+    return country_alias_index().get(normalize(place_name), (None, None))
+
+
+def match_subdivision(place_name):
+    '''Return the alpha_3 code and name of the country of the subdivision with
+    this name, ignoring accents and case, or None, None if there is none
+    '''
+    return subdivision_index().get(normalize(place_name), (None, None))
+
+
+def country_centroid(country_code):
+    '''Return the "lat,long" centroid of the country with this alpha_3 code, or None'''
+    return country_centroids().get(country_code)
+
+
+def iso3_code(iso2, default='XXX'):
+    '''Return the alpha_3 code of the country with this alpha_2 code'''
+    return alpha_3_index().get(iso2, default)
+
+
+def iso2_code(iso3, default=None):
+    '''Return the alpha_2 code of the country with this alpha_3 code'''
+    return alpha_2_index().get(iso3, default)
@@ -1,37 +1,116 @@
+import logging
 import os
+import random
+import threading
+import time
+
 import requests
-import pycountry
 
+from idetect import gazetteer
 from idetect.model import LocationType
+from idetect.rate_limiter import DatabaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+NOMINATIM_URL = os.environ.get('NOMINATIM_URL', 'http://nominatim.openstreetmap.org/search')
+# Requests per second to Nominatim, shared by all the geotagger processes
+NOMINATIM_RATE = float(os.environ.get('NOMINATIM_RATE', '1'))
+# Number of lookups made concurrently by each process, within NOMINATIM_RATE
+NOMINATIM_CONCURRENCY = int(os.environ.get('NOMINATIM_CONCURRENCY', '4'))
+NOMINATIM_RETRIES = int(os.environ.get('NOMINATIM_RETRIES', '3'))
+NOMINATIM_TIMEOUT = 10
+NOMINATIM_BACKOFF = 1.0
+
 
 class GeotagException(Exception):
     pass
 
 
+class NominatimClient(object):
+    '''Make Nominatim searches within a request rate shared across processes,
+    retrying connection errors, timeouts, 429 and 5xx responses with exponential backoff.
+
+    Parameters
+    ----------
+    url : Nominatim search URL
+    rate_limiter : object with an acquire method, called before each request
+    retries : number of retries of a failed request
+    timeout : seconds to wait for a response
+    backoff : seconds to wait before the first retry, doubled for each retry
+    '''
+
+    def __init__(self, url=NOMINATIM_URL, rate_limiter=None, retries=NOMINATIM_RETRIES,
+                 timeout=NOMINATIM_TIMEOUT, backoff=NOMINATIM_BACKOFF):
+        self.url = url
+        self.rate_limiter = rate_limiter or DatabaseRateLimiter('nominatim', NOMINATIM_RATE)
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.local = threading.local()
+
+    @property
+    def http(self):
+        # requests sessions are not thread safe, so keep one per thread
+        if not hasattr(self.local, 'http'):
+            self.local.http = requests.Session()
+            self.local.http.headers['User-Agent'] = 'idetect'
+        return self.local.http
+
+    def search(self, params):
+        '''Return the decoded results of a search, or raise GeotagException'''
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+            try:
+                response = self.http.get(self.url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code == 429 or response.status_code >= 500:
+                    error = "status {}".format(response.status_code)
+                    retry_after = response.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+                else:
+                    try:
+                        response.raise_for_status()
+                        return response.json()
+                    except ValueError as e:
+                        raise GeotagException("Invalid response from Nominatim: {}".format(e))
+                    except requests.HTTPError as e:
+                        raise GeotagException(str(e))
+            if attempt < self.retries:
+                logger.warning("Nominatim request for {} failed ({}), retrying in {:.1f}s".format(
+                    params.get('q'), error, delay))
+                time.sleep(delay)
+        raise GeotagException("Nominatim request for {} failed {} times: {}".format(
+            params.get('q'), self.retries + 1, error))
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = NominatimClient()
+    return _client
+
+
 def match_iso3(iso2):
     '''Try and match the iso2 with is3
     return the country code if found
     '''
-    countries = (c for c in list(pycountry.countries))
-    for country in countries:  # Loop through all countries
-        if country.alpha_2 == iso2:  # Look directly at iso2
-            return country.alpha_3
-            break
-    return 'XXX'
+    return gazetteer.iso3_code(iso2)
 
 def nominatim_coordinates(place_name, country_code='XXX'):
-    base_url='http://nominatim.openstreetmap.org/search'
     base_params = {'q':place_name,'addressdetails': 1,'format':'json','extratags':1,'accept-language':'en'}
     if country_code != 'XXX':
-        try:
-            country=pycountry.countries.get(alpha_3=country_code)
-            base_params['countrycodes'] = country.alpha_2.lower()
-        except:
-            pass
+        iso2 = gazetteer.iso2_code(country_code)
+        if iso2:
+            base_params['countrycodes'] = iso2.lower()
+    data = get_client().search(base_params)
     try:
-        resp = requests.get(base_url, params=base_params)
-        res = resp.json()        
-        data = res
         if len(data) == 0:
             return {'place_name': place_name, 'type': '',
                     'country_code': country_code,
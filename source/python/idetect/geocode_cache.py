@@ -0,0 +1,91 @@
+'''Persistent cache of geocoding results.
+
+Results are keyed by the normalized place name and the alpha_3 code of the
+country the lookup was restricted to ('XXX' for none). Place names that
+Nominatim does not know and failed lookups are cached as well, for a shorter
+time, so that they do not cost a request every time they are mentioned.
+'''
+import os
+from datetime import timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import func
+
+from idetect.gazetteer import normalize
+from idetect.model import GeocodeCache, Session
+
+GEOCODE_CACHE_TTL_DAYS = int(os.environ.get('GEOCODE_CACHE_TTL_DAYS', '90'))
+GEOCODE_NEGATIVE_TTL_DAYS = int(os.environ.get('GEOCODE_NEGATIVE_TTL_DAYS', '7'))
+GEOCODE_ERROR_TTL_MINUTES = int(os.environ.get('GEOCODE_ERROR_TTL_MINUTES', '10'))
+
+NO_RESULTS = 'no-results'
+ERROR = 'error'
+
+
+def time_to_live(flag):
+    if flag == ERROR:
+        return timedelta(minutes=GEOCODE_ERROR_TTL_MINUTES)
+    if flag == NO_RESULTS:
+        return timedelta(days=GEOCODE_NEGATIVE_TTL_DAYS)
+    return timedelta(days=GEOCODE_CACHE_TTL_DAYS)
+
+
+def cache_key(place_name, country_code='XXX'):
+    return normalize(' '.join(place_name.split())), country_code or 'XXX'
+
+
+def lookup(session, place_name, country_code='XXX'):
+    '''Return the cached GeocodeCache entry for this query if it has not expired, or None'''
+    key, hint = cache_key(place_name, country_code)
+    cached = session.query(GeocodeCache, func.now()) \
+        .filter(GeocodeCache.place_name == key, GeocodeCache.country_hint == hint) \
+        .one_or_none()
+    if cached is None:
+        return None
+    entry, now = cached
+    if now - entry.updated > time_to_live(entry.flag):
+        return None
+    return entry
+
+
+def store(place_name, country_code, geo_info, error_msg=None):
+    '''Save the result of geocoding place_name, or an error with its message if geo_info is None.
+    The entry is committed in a session of its own, so that the transaction of the caller,
+    e.g. the geotagging of an analysis, is left for the caller to commit or roll back.
+    '''
+    key, hint = cache_key(place_name, country_code)
+    if geo_info is None:
+        values = dict(flag=ERROR, location_type=None, country_iso3=None, latlong=None, error_msg=error_msg)
+    else:
+        values = dict(flag=geo_info['flag'], location_type=geo_info['type'],
+                      country_iso3=geo_info['country_code'], latlong=geo_info['coordinates'], error_msg=None)
+    values['updated'] = func.now()
+    statement = insert(GeocodeCache.__table__).values(place_name=key, country_hint=hint, **values)
+    session = Session()
+    try:
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[GeocodeCache.place_name, GeocodeCache.country_hint], set_=values))
+        session.commit()
+    finally:
+        session.close()
+
+
+def geo_info(entry, place_name):
+    '''Turn a cached entry back into the dict returned by nominatim_coordinates'''
+    return {'place_name': place_name, 'type': entry.location_type or '',
+            'country_code': entry.country_iso3, 'flag': entry.flag,
+            'coordinates': entry.latlong or ''}
+
+
+def purge_geocode_cache(session):
+    '''Delete the entries that have expired'''
+    now = func.now()
+    deleted = 0
+    for flag_filter, ttl in ((GeocodeCache.flag == ERROR, time_to_live(ERROR)),
+                             (GeocodeCache.flag == NO_RESULTS, time_to_live(NO_RESULTS)),
+                             (GeocodeCache.flag.notin_([ERROR, NO_RESULTS]), time_to_live(None))):
+        deleted += session.query(GeocodeCache) \
+            .filter(flag_filter, GeocodeCache.updated < now - ttl) \
+            .delete(synchronize_session=False)
+    session.commit()
+    return deleted
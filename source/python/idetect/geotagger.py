@@ -1,12 +1,29 @@
 '''Method(s) for getting geo info.
 '''
+import os
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
-import pycountry
 from itertools import groupby
-from idetect.model import LocationType, Fact
-from idetect.geo_external import nominatim_coordinates, GeotagException
+from idetect import gazetteer, geocode_cache, local_geocoder
+from idetect.model import LocationType, Fact, Location, LocationQueue, LocationStatus, Analysis, Status, \
+    Session, analysis_fact, fact_location
+from idetect.geo_external import nominatim_coordinates, GeotagException, NOMINATIM_CONCURRENCY
+from sqlalchemy import and_, bindparam, exists, literal, or_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import object_session
+from sqlalchemy.sql import func
+
+# When set, locations are geocoded once each by run_location_geocoder, and the geotagger
+# only takes analyses whose locations are all geocoded
+USE_LOCATION_QUEUE = os.environ.get('USE_LOCATION_QUEUE', 'False').lower() == 'true'
+# Number of times a location is tried before its analyses fail geotagging
+LOCATION_MAX_ATTEMPTS = 3
+# Seconds after which a location left in geocoding by a worker that died is queued again
+LOCATION_GEOCODING_TIMEOUT = 300
+# Hours after which a location that failed LOCATION_MAX_ATTEMPTS times is tried again from scratch
+LOCATION_RETRY_HOURS = int(os.environ.get('LOCATION_RETRY_HOURS', '24'))
 
 
 def process_locations(analysis):
@@ -14,51 +31,116 @@ def process_locations(analysis):
     :params analysis: instance of Analysis
     :return: None
     '''
-    session = object_session(analysis)
-    facts = analysis.facts
-    for fact in facts:
-        if len(fact.locations) > 0:
-            process_fact(fact, analysis, session)
+    failures = process_locations_batch([analysis])
+    if analysis in failures:
+        raise failures[analysis]
 
 
-def process_fact(fact, analysis, session):
-    '''Geotag locations for a given fact
-    If the locations represent multiple countries, duplicate
-    the fact for each country
-    :params fact: instance of Fact
-    :params analysis: instance of Analysis
-    :params session: object session for Analysis
-    :return: None
+def process_locations_batch(analyses):
+    '''Geotag the locations of a batch of articles, geocoding each location once,
+    and save the countries of their facts in one transaction
+    :params analyses: list of Analysis instances from the same session
+    :return: dict of the Analyses that failed to the exception raised for each
     '''
-    for location in fact.locations:
-        if location.country == '' or location.country is None:
-            process_location(location, session)
-
-    country_locations = fact.locations
-    country_locations.sort(key=lambda x: x.country.iso3)
-    country_groups = [(key, [loc for loc in group]) for key, group in groupby(country_locations, lambda x: x.country.iso3)]
-    # If all locations from same country
-    # Update the Fact iso3 field, then done
-    if len(country_groups) == 1:
-        fact.iso3 = country_groups[0][0]
-        session.commit()
+    session = object_session(analyses[0])
+    facts = {analysis: [fact for fact in analysis.facts if len(fact.locations) > 0] for analysis in analyses}
+    ungeocoded = [location for analysis in analyses for fact in facts[analysis] for location in fact.locations
+                  if location.country_iso3 is None]
+    if USE_LOCATION_QUEUE:
+        errors = {location.id: GeotagException("Location '{}' could not be geocoded".format(location.location_name))
+                  for location in ungeocoded}
     else:
-        # Empty the fact locations
-        fact.locations = []
-        # Update the iso3 and locations for original fact
-        fact.iso3 = country_groups[0][0]
-        fact.locations = [location for location in country_groups[0][1]]
-        # Duplicate the fact for the remaining countries
-        for key, group in country_groups[1:]:
-            f = Fact(unit=fact.unit, term=fact.term,
-                excerpt_start=fact.excerpt_start, excerpt_end=fact.excerpt_end,
-                specific_reported_figure=fact.specific_reported_figure,
-                vague_reported_figure=fact.vague_reported_figure, iso3=key,
-                tag_locations=fact.tag_locations)
-            session.add(f)
-            analysis.facts.append(f)
-            f.locations.extend([location for location in group])
-        session.commit()
+        errors = geocode_locations(ungeocoded)
+    failures = {}
+    for analysis in analyses:
+        for location in (l for fact in facts[analysis] for l in fact.locations):
+            if location.id in errors:
+                failures[analysis] = errors[location.id]
+                break
+    split_facts([(analysis, facts[analysis]) for analysis in analyses if analysis not in failures], session)
+    session.commit()
+    return failures
+
+
+def geocode_locations(locations):
+    '''Geotag and update the given location objects, looking them up concurrently,
+    leaving the caller to commit
+    :params locations: list of Location instances
+    :return: dict of the ids of the locations that could not be geotagged to the exception raised for each
+    '''
+    locations = list({location.id: location for location in locations}.values())
+    if len(locations) == 0:
+        return {}
+    session = object_session(locations[0])
+    errors = {}
+    geo_infos = get_geo_infos([location.location_name for location in locations], session)
+    for location, loc_info in zip(locations, geo_infos):
+        if isinstance(loc_info, Exception):
+            errors[location.id] = loc_info
+            continue
+        location.location_type = loc_info['type']
+        location.country_iso3 = loc_info['country_code']
+        location.latlong = loc_info['coordinates']
+    return errors
+
+
+def country_groups(fact):
+    '''Group the locations of a fact by country
+    :params fact: instance of Fact with geotagged locations
+    :return: list of (iso3, list of locations) pairs, ordered by iso3
+    '''
+    locations = sorted(fact.locations, key=lambda x: x.country_iso3)
+    return [(key, list(group)) for key, group in groupby(locations, lambda x: x.country_iso3)]
+
+
+def split_facts(facts_by_analysis, session):
+    '''Set the iso3 of each fact to the country of its locations. If the locations
+    represent multiple countries, keep the first country's locations on the fact and
+    duplicate the fact for each other country, moving their locations to the duplicates.
+    All the changes are written with a few multi-row statements, leaving the caller to commit.
+    :params facts_by_analysis: list of (Analysis, list of its Facts with locations) pairs
+    :params session: session object
+    :return: None
+    '''
+    updates = []
+    duplicates = []
+    for analysis, facts in facts_by_analysis:
+        for fact in facts:
+            groups = country_groups(fact)
+            updates.append({'fact_id': fact.id, 'fact_iso3': groups[0][0]})
+            duplicates.extend((analysis, fact, key, group) for key, group in groups[1:])
+    # the geotagged locations must be written before the statements below
+    session.flush()
+    if updates:
+        session.execute(Fact.__table__.update()
+                        .where(Fact.id == bindparam('fact_id'))
+                        .values(iso3=bindparam('fact_iso3')), updates)
+    if duplicates:
+        fact_ids = Fact.allocate_ids(session, len(duplicates))
+        session.execute(Fact.__table__.insert().values([
+            dict(id=fact_id, unit=fact.unit, term=fact.term,
+                 excerpt_start=fact.excerpt_start, excerpt_end=fact.excerpt_end,
+                 specific_reported_figure=fact.specific_reported_figure,
+                 vague_reported_figure=fact.vague_reported_figure, iso3=key,
+                 tag_locations=fact.tag_locations)
+            for fact_id, (analysis, fact, key, group) in zip(fact_ids, duplicates)
+        ]))
+        session.execute(analysis_fact.insert().values([
+            {'analysis': analysis.gkg_id, 'fact': fact_id}
+            for fact_id, (analysis, fact, key, group) in zip(fact_ids, duplicates)
+        ]))
+        session.execute(fact_location.update()
+                        .where(and_(fact_location.c.fact == bindparam('old_fact'),
+                                    fact_location.c.location == bindparam('location_id')))
+                        .values(fact=bindparam('new_fact')),
+                        [{'old_fact': fact.id, 'location_id': location.id, 'new_fact': fact_id}
+                         for fact_id, (analysis, fact, key, group) in zip(fact_ids, duplicates)
+                         for location in group])
+    # the facts and their locations were changed behind the back of the session
+    for analysis, facts in facts_by_analysis:
+        session.expire(analysis, ['facts'])
+        for fact in facts:
+            session.expire(fact)
 
 
 def process_location(location, session):
@@ -67,18 +149,104 @@ def process_location(location, session):
     :params session: session object
     :return: None
     '''
-    loc_info = get_geo_info(location.location_name)
+    loc_info = get_geo_info(location.location_name, session)
     location.location_type = loc_info['type']
     location.country_iso3 = loc_info['country_code']
     location.latlong = loc_info['coordinates']
     session.commit()
 
 
-def get_geo_info(place_name):
+def enqueue_locations(session):
+    '''Queue the locations without a country of the extracted analyses, once each,
+    and queue again the locations that failed or were left in geocoding by a worker that died.
+    Locations that failed LOCATION_MAX_ATTEMPTS times are queued again LOCATION_RETRY_HOURS later,
+    with their attempts reset.
+    :params session: session object
+    :return: number of locations added or queued again
+    '''
+    retried = session.query(LocationQueue).filter(
+        LocationQueue.status == LocationStatus.FAILED,
+        LocationQueue.attempts >= LOCATION_MAX_ATTEMPTS,
+        LocationQueue.updated < func.now() - timedelta(hours=LOCATION_RETRY_HOURS)
+    ).update({LocationQueue.status: LocationStatus.PENDING, LocationQueue.attempts: 0},
+             synchronize_session=False)
+    requeued = session.query(LocationQueue).filter(or_(
+        and_(LocationQueue.status == LocationStatus.GEOCODING,
+             LocationQueue.updated < func.now() - timedelta(seconds=LOCATION_GEOCODING_TIMEOUT)),
+        and_(LocationQueue.status == LocationStatus.FAILED,
+             LocationQueue.attempts < LOCATION_MAX_ATTEMPTS,
+             LocationQueue.updated < func.now() - timedelta(minutes=geocode_cache.GEOCODE_ERROR_TTL_MINUTES))
+    )).update({LocationQueue.status: LocationStatus.PENDING}, synchronize_session=False)
+    locations = session.query(Location.id, literal(LocationStatus.PENDING)).distinct() \
+        .join(fact_location, fact_location.c.location == Location.id) \
+        .join(analysis_fact, analysis_fact.c.fact == fact_location.c.fact) \
+        .join(Analysis, Analysis.gkg_id == analysis_fact.c.analysis) \
+        .filter(Analysis.status == Status.EXTRACTED, Location.country_iso3 == None)
+    added = session.execute(
+        insert(LocationQueue.__table__)
+            .from_select([LocationQueue.location_id, LocationQueue.status], locations)
+            .on_conflict_do_nothing()
+    ).rowcount
+    session.commit()
+    return retried + requeued + added
+
+
+def locations_geocoded(query):
+    '''Filter an Analysis query down to the extracted analyses whose locations all have
+    a country, or have failed to get one LOCATION_MAX_ATTEMPTS times
+    '''
+    given_up = exists().where(and_(LocationQueue.location_id == Location.id,
+                                   LocationQueue.status == LocationStatus.FAILED,
+                                   LocationQueue.attempts >= LOCATION_MAX_ATTEMPTS))
+    unresolved = exists().where(and_(analysis_fact.c.analysis == Analysis.gkg_id,
+                                     fact_location.c.fact == analysis_fact.c.fact,
+                                     Location.id == fact_location.c.location,
+                                     Location.country_iso3 == None,
+                                     ~given_up))
+    return query.filter(Analysis.status == Status.EXTRACTED, ~unresolved)
+
+
+def geocode_location(location):
+    '''Geotag a queued location, caching the lookups in its session
+    :params location: instance of Location
+    :return: None
+    '''
+    process_location(location, object_session(location))
+
+
+def get_geo_infos(place_names, session=None):
+    '''get_geo_info for each of the place names, up to NOMINATIM_CONCURRENCY at a time.
+    If session is given, the cache is used, each lookup reading it in a session of its own.
+    A lookup that fails gives the exception it raised instead of a dict.
+    '''
+    def lookup_in(place_name, lookup_session):
+        try:
+            return get_geo_info(place_name, lookup_session)
+        except Exception as e:
+            return e
+
+    if len(place_names) <= 1 or NOMINATIM_CONCURRENCY <= 1:
+        return [lookup_in(place_name, session) for place_name in place_names]
+
+    def lookup(place_name):
+        if session is None:
+            return lookup_in(place_name, None)
+        thread_session = Session()
+        try:
+            return lookup_in(place_name, thread_session)
+        finally:
+            thread_session.close()
+
+    with ThreadPoolExecutor(min(NOMINATIM_CONCURRENCY, len(place_names))) as executor:
+        return list(executor.map(lookup, place_names))
+
+
+def get_geo_info(place_name, session=None):
     '''This exposes the internal geo tagging functionality.
     In fact extraction, the geo tagging solution can be internal or external.
 
     :params place_name: A place name to get info for
+    :params session: session used to cache the Nominatim lookups, if given
     :return: Dict of geo_info for each place name:
         place_name: original place name provided as param
         country_code: 3-letter ISO country code
@@ -88,16 +256,59 @@ def get_geo_info(place_name):
     '''
 
     country_info = city_subdivision_country(place_name)
+    if country_info and country_info['type'] == LocationType.COUNTRY:
+        centroid = gazetteer.country_centroid(country_info['country_code'])
+        if centroid:
+            country_info['coordinates'] = centroid
+            country_info['flag'] = 'single-result'
+            return country_info
     if country_info:
-        coords = nominatim_coordinates(place_name, country_info['country_code'])
+        coords = geocode(place_name, country_info['country_code'], session)
         country_info['coordinates'] = coords['coordinates']
         country_info['flag'] = coords['flag']
     else:
-        country_info = nominatim_coordinates(place_name)
+        country_info = geocode(place_name, session=session)
 
     return country_info
 
 
+def geocode(place_name, country_code='XXX', session=None):
+    '''Look the place up in the local geocoder index if there is one, and on
+    Nominatim if it is not found there and NOMINATIM_FALLBACK is set
+    '''
+    geocoder = local_geocoder.get_local_geocoder()
+    if geocoder is not None:
+        geo_info = geocoder.geocode(place_name, country_code)
+        if geo_info is not None:
+            return geo_info
+        if not local_geocoder.NOMINATIM_FALLBACK:
+            return {'place_name': place_name, 'type': '',
+                    'country_code': country_code,
+                    'flag': 'no-results', 'coordinates': ''}
+    return cached_nominatim_coordinates(place_name, country_code, session)
+
+
+def cached_nominatim_coordinates(place_name, country_code='XXX', session=None):
+    '''Call nominatim_coordinates, unless the result of the same query is in
+    the geocode cache. Failures are cached for a short time and raise
+    GeotagException again until they expire.
+    '''
+    if session is None:
+        return nominatim_coordinates(place_name, country_code)
+    entry = geocode_cache.lookup(session, place_name, country_code)
+    if entry is not None:
+        if entry.flag == geocode_cache.ERROR:
+            raise GeotagException(entry.error_msg or "Cached geocoding failure for {}".format(place_name))
+        return geocode_cache.geo_info(entry, place_name)
+    try:
+        geo_info = nominatim_coordinates(place_name, country_code)
+    except GeotagException as e:
+        geocode_cache.store(place_name, country_code, None, str(e))
+        raise
+    geocode_cache.store(place_name, country_code, geo_info)
+    return geo_info
+
+
 def strip_accents(s):
     '''Strip out accents from text'''
     return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
@@ -127,32 +338,14 @@ def subdivision_country_code(place_name):
     at country subdivisions i.e. States, Provinces etc.
     return the country code if found
     '''
-    subdivisions = (s for s in list(pycountry.subdivisions))
-    for sub_division in subdivisions:
-        if compare_strings(sub_division.name, place_name):
-            return sub_division.country.alpha_3, sub_division.country.name
-            break
-    return None, None
+    return gazetteer.match_subdivision(place_name)
 
 
 def match_country_name(place_name):
     '''Try and match the country name directly
     return the country code if found
     '''
-    countries = (c for c in list(pycountry.countries))
-    for country in countries:  # Loop through all countries
-        if country.name == place_name:  # Look directly at country name
-            return country.alpha_3, country.name
-            break
-        # In some cases the country also has a common name
-        elif hasattr(country, 'common_name') and country.common_name == place_name:
-            return country.alpha_3, country.common_name
-            break
-        # In some cases the country also has an official name
-        elif hasattr(country, 'official_name') and country.official_name == place_name:
-            return country.alpha_3, country.name
-            break
-    return None, None
+    return gazetteer.match_country(place_name)
 
 
 def city_subdivision_country(place_name):
@@ -162,11 +355,11 @@ def city_subdivision_country(place_name):
         '''
     country_code, country_name = match_country_name(place_name)
     if country_code:
-        return {'place_name': place_name, 'country_code': country_code, 'type': 'country'}
+        return {'place_name': place_name, 'country_code': country_code, 'type': LocationType.COUNTRY}
 
     # Try getting the country code using a subdivision name
     country_code, country_name = subdivision_country_code(place_name)
     if country_code:
-        return {'place_name': place_name, 'country_code': country_code, 'type': 'subdivision'}
+        return {'place_name': place_name, 'country_code': country_code, 'type': LocationType.SUBDIVISION}
 
     return None
@@ -0,0 +1,221 @@
+'''Local inference service holding the classifier models once per host.
+
+The service listens on a Unix socket. Each request is a line of JSON
+{"model": <name>, "text": <text>}, or {"model": <name>, "method": "version"}
+for the version of the model, and gets a line of JSON back, either
+{"result": <prediction>} or {"error": <message>}. Requests for the same model
+arriving within a short window are predicted together in one batch.
+'''
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# When set, classification goes through the inference service listening on this socket
+INFERENCE_SOCKET = os.environ.get('INFERENCE_SOCKET')
+DEFAULT_SOCKET = '/tmp/idetect-inference.sock'
+
+
+class InferenceException(Exception):
+    pass
+
+
+class PendingPrediction(object):
+    '''A text waiting in a batch for its prediction'''
+
+    def __init__(self, text):
+        self.text = text
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Batcher(object):
+    '''Collects texts for one model and predicts them in batches.
+
+    Parameters
+    ----------
+    model : a CategoryModel or RelevanceModel, with predict and predict_batch methods
+    batch_window : seconds to wait for more texts after the first one of a batch
+    max_batch : maximum number of texts predicted together
+    '''
+
+    def __init__(self, model, batch_window=0.02, max_batch=32):
+        self.model = model
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def predict(self, text):
+        '''Queue a text and wait for its prediction'''
+        pending = PendingPrediction(text)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error:
+            raise pending.error
+        return pending.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.predict_batch(batch)
+
+    def predict_batch(self, batch):
+        try:
+            results = self.model.predict_batch([p.text for p in batch])
+            for pending, result in zip(batch, results):
+                pending.result = result
+        except Exception:
+            # A single bad text (e.g. an empty one) fails the whole batch,
+            # so fall back to predicting them one by one
+            for pending in batch:
+                try:
+                    pending.result = self.model.predict(pending.text)
+                except Exception as e:
+                    pending.error = e
+        logger.debug("Predicted batch of {} texts".format(len(batch)))
+        for pending in batch:
+            pending.done.set()
+
+
+class InferenceHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                batcher = self.server.batchers[request['model']]
+                if request.get('method') == 'version':
+                    response = {'result': getattr(batcher.model, 'version', None)}
+                else:
+                    response = {'result': batcher.predict(request['text'])}
+            except Exception as e:
+                response = {'error': '{}: {}'.format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Serve predictions of the given models on a Unix socket.
+
+    Parameters
+    ----------
+    socket_path : path of the Unix socket to listen on
+    models : dict of model name to model
+    batch_window, max_batch : see Batcher
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, models, batch_window=0.02, max_batch=32):
+        self.batchers = {name: Batcher(model, batch_window, max_batch)
+                         for name, model in models.items()}
+        # remove the socket left behind by a previous run
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, InferenceHandler)
+
+
+class InferenceClient(object):
+    '''Client for the inference service. Connects lazily, and again after a fork.
+    Threads share the connection, one request at a time.
+    '''
+
+    def __init__(self, socket_path, timeout=60):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.file = None
+        self.pid = None
+        # Held from sending a request until its reply is read, so replies are not mixed up
+        self.lock = threading.Lock()
+        # Number of connections made so far, to tell when the service may have changed
+        self.connections = 0
+
+    def connect(self):
+        self.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+        self.file = self.sock.makefile('rwb')
+        self.pid = os.getpid()
+        self.connections += 1
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.file.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.file = None
+
+    def predict(self, model, text):
+        return self.request({'model': model, 'text': text})
+
+    def version(self, model):
+        return self.request({'model': model, 'method': 'version'})
+
+    def request(self, message):
+        request = json.dumps(message).encode('utf-8') + b'\n'
+        with self.lock:
+            try:
+                if self.sock is None or self.pid != os.getpid():
+                    self.connect()
+                self.file.write(request)
+                self.file.flush()
+                line = self.file.readline()
+            except OSError as e:
+                self.close()
+                raise InferenceException("Inference service unavailable at {}: {}".format(self.socket_path, e))
+            if not line:
+                self.close()
+                raise InferenceException("Inference service at {} closed the connection".format(self.socket_path))
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise InferenceException(response['error'])
+        return response['result']
+
+
+class RemoteModel(object):
+    '''Stands in for a CategoryModel or RelevanceModel held by the inference service'''
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._version = None
+        self._connection = None
+
+    @property
+    def version(self):
+        # Kept until the client connects again, as the service may have been restarted with a new model
+        if self._version is None or self._connection != self.client.connections:
+            self._version = self.client.version(self.name)
+            self._connection = self.client.connections
+        return self._version
+
+    def predict(self, text):
+        return self.client.predict(self.name, text)
+
+
+def remote_models(socket_path=None):
+    '''Return category and relevance models served by the inference service'''
+    client = InferenceClient(socket_path or INFERENCE_SOCKET or DEFAULT_SOCKET)
+    return RemoteModel(client, 'category'), RemoteModel(client, 'relevance')
@@ -1,10 +1,13 @@
+import copy
 import re
 import string
 from datetime import datetime, timedelta
 
 import parsedatetime
-from spacy.tokens import Token, Span
+from spacy.tokens import Doc, Token, Span
 from spacy.symbols import ORTH, LEMMA, POS
+from sqlalchemy import func, literal_column
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from textacy.extract import pos_regex_matches
 from textacy.spacy_utils import get_main_verbs_of_sent, get_objects_of_verb, get_subjects_of_verb
 
@@ -82,46 +85,123 @@ def tokenizer_add_hyphened_numbers(nlp, pre, post):
                                        }])
 
 
+# Tokenizers that already have the custom cases
+_tokenizers_with_cases = set()
+
+
 def load_custom_tokenizer_cases(nlp):
+    if id(nlp.tokenizer) in _tokenizers_with_cases:
+        return
     for pre in ['twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy', 'eighty', 'ninety']:
         for post in ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine']:
             tokenizer_add_hyphened_numbers(nlp, pre, post)
+    _tokenizers_with_cases.add(id(nlp.tokenizer))
 
 
 def load_keywords(nlp, session, keyword_type):
     keywords = [t.description for t in session.query(
         FactKeyword).filter_by(keyword_type=keyword_type).all()]
+    return lemmatize_keywords(nlp, keywords)
+
+
+def load_all_keywords(session):
+    """Return a dict of keyword type to the list of keywords of that type"""
+    keywords = {}
+    for keyword_type, description in session.query(FactKeyword.keyword_type, FactKeyword.description) \
+            .order_by(FactKeyword.id):
+        keywords.setdefault(keyword_type, []).append(description)
+    return keywords
+
+
+def keywords_version(session):
+    """Digest of the keywords table, which changes whenever a keyword is added, edited or removed"""
+    keyword = func.concat(FactKeyword.keyword_type, ':', FactKeyword.description)
+    return session.query(
+        func.md5(func.string_agg(keyword, aggregate_order_by(literal_column("','"), FactKeyword.id)))
+    ).scalar()
+
+
+def lemmatize_keywords(nlp, keywords):
     return [t.lemma_ for t in nlp(" ".join(keywords))]
 
 
 class Interpreter(object):
 
-    def __init__(self, session, nlp):
+    def __init__(self, session, nlp, keywords=None):
+        """
+        param: session: session used to load the keywords
+        param: nlp: a spaCy Language instance
+        param: keywords: optional dict of keyword type to keywords, as returned by
+            load_all_keywords, used instead of loading them from the session
+        """
         self.nlp = nlp
-        self.person_term_lemmas = load_keywords(
-            self.nlp, session, KeywordType.PERSON_TERM)
-        self.structure_term_lemmas = load_keywords(
-            self.nlp, session, KeywordType.STRUCTURE_TERM)
+        if keywords is None:
+            keywords = load_all_keywords(session)
+        self.person_term_lemmas = lemmatize_keywords(
+            self.nlp, keywords.get(KeywordType.PERSON_TERM, []))
+        self.structure_term_lemmas = lemmatize_keywords(
+            self.nlp, keywords.get(KeywordType.STRUCTURE_TERM, []))
         self.joint_term_lemmas = list(
             set(self.structure_term_lemmas) & set(self.person_term_lemmas))
-        self.person_unit_lemmas = load_keywords(
-            self.nlp, session, KeywordType.PERSON_UNIT)
-        self.structure_unit_lemmas = load_keywords(
-            self.nlp, session, KeywordType.STRUCTURE_UNIT)
+        self.person_unit_lemmas = lemmatize_keywords(
+            self.nlp, keywords.get(KeywordType.PERSON_UNIT, []))
+        self.structure_unit_lemmas = lemmatize_keywords(
+            self.nlp, keywords.get(KeywordType.STRUCTURE_UNIT, []))
         self.household_lemmas = [t.lemma_ for t in self.nlp(
             " ".join(["families", "households"]))]
         self.reporting_term_lemmas = self.person_term_lemmas + self.structure_term_lemmas
         self.reporting_unit_lemmas = self.person_unit_lemmas + self.structure_unit_lemmas
-        self.relevant_article_lemmas = load_keywords(
-            self.nlp, session, KeywordType.ARTICLE_KEYWORD)
+        self.relevant_article_lemmas = lemmatize_keywords(
+            self.nlp, keywords.get(KeywordType.ARTICLE_KEYWORD, []))
+        # A report needs a verb or object with one of these lemmas, see verb_relevance
+        self.trigger_lemmas = set(self.reporting_term_lemmas) | {
+            'eviction', 'leave', 'render', 'become', 'affect', 'fear', 'assume', 'claim'}
         load_custom_tokenizer_cases(self.nlp)
+        # Sentences of the last Doc processed parsed on their own, see sentence_doc
+        self.sentences_doc = None
+        self.sentence_docs = {}
+        # Lemmas of single words, see word_lemma
+        self.word_lemmas = {}
 
+    def sentence_doc(self, sentence):
+        """
+        Parse a sentence on its own, once per sentence of the Doc being processed.
+        The entities and noun chunks are taken from this parse, which can differ
+        from the parse of the whole article.
+        param: sentence: a span
+        returns: a Spacy Doc
+        """
+        if self.sentences_doc is not sentence.doc:
+            self.sentences_doc = sentence.doc
+            self.sentence_docs = {}
+        doc = self.sentence_docs.get(sentence.start)
+        if doc is None:
+            doc = self.nlp(sentence.text)
+            self.sentence_docs[sentence.start] = doc
+        return doc
+
+    def word_lemma(self, word):
+        """
+        Get the lemma of a single word, tagging it without parsing.
+        param: word: a String
+        returns: a String
+        """
+        lemma = self.word_lemmas.get(word)
+        if lemma is None:
+            lemma = self.nlp(word, parse=False, entity=False)[0].lemma_
+            self.word_lemmas[word] = lemma
+        return lemma
 
     def check_if_collection_contains_token(self, token, collection):
-        for c in collection:
-            if token.i == c.i:
-                return True
-        return False
+        """
+        Test if a collection contains a token with the same index as the given token.
+        param: token: a token
+        param: collection: a span, or an iterable of tokens
+        returns: Boolean
+        """
+        if isinstance(collection, Span):
+            return collection.start <= token.i < collection.end
+        return token.i in {c.i for c in collection}
 
     def get_descendents(self, sentence, root=None):
         """
@@ -132,7 +212,9 @@ class Interpreter(object):
         """
         if not root:
             root = sentence.root
-        return [t for t in sentence if root.is_ancestor_of(t)]
+        subtree = {t.i for t in root.subtree}
+        subtree.discard(root.i)
+        return [t for t in sentence if t.i in subtree]
 
     def check_if_entity_contains_token(self, tokens, entity):
         """
@@ -142,93 +224,108 @@ class Interpreter(object):
 
         returns: Boolean
         """
-        tokens_ = [t.text for t in tokens]
+        tokens_ = {t.text for t in tokens}
         for token in entity:
             if token.text in tokens_:
                 return True
         return False
 
+    def get_ancestor_indices(self, token):
+        """
+        Gets the indices of the ancestors of a token, from its head up to the root of the tree.
+        param: token: a token
+
+        returns: a list of token indices
+        """
+        return [a.i for a in token.ancestors]
+
     def get_distance_from_root(self, token, root):
         """
         Gets the parse tree distance between a token and the sentence root.
         :param token: a token
-        :param root: the root token of the sentence
+        :param root: the root token of the sentence, or an ancestor of token
 
-        returns: an integer distance
+        returns: an integer distance, or None if root is neither token nor one of its
+            ancestors (this used to loop until it failed), so callers doing arithmetic
+            on the distance must check for None first
         """
-        if token == root:
+        if token.i == root.i:
             return 0
-        d = 1
-        p = token.head
-        while p is not root:
-            d += 1
-            p = p.head
-        return d
+        for d, i in enumerate(self.get_ancestor_indices(token), start=1):
+            if i == root.i:
+                return d
+        return None
 
     def get_common_ancestors(self, tokens):
-        ancestors = [set(t.ancestors) for t in tokens]
+        """
+        Gets the tokens that are ancestors of all the given tokens.
+        :param tokens: a list of tokens
+
+        returns: a set of token indices
+        """
+        ancestors = [set(self.get_ancestor_indices(t)) for t in tokens]
         if len(ancestors) == 0:
-            return []
-        common_ancestors = ancestors[0].intersection(*ancestors)
-        return common_ancestors
+            return set()
+        return ancestors[0].intersection(*ancestors)
 
     def get_distance_between_tokens(self, token_a, token_b):
+        """
+        Gets the parse tree distance between two tokens, through their lowest common ancestor.
+        :param token_a: a token
+        :param token_b: a token
 
-        if token_b in token_a.subtree:
-            distance = self.get_distance_from_root(token_b, token_a)
-        elif token_a in token_b.subtree:
-            distance = self.get_distance_from_root(token_a, token_b)
-        else:
-            common_ancestors = self.get_common_ancestors([token_a, token_b])
-            distance = 10000
-            for ca in common_ancestors:
-                distance_a = self.get_distance_from_root(ca, token_a)
-                distance_b = self.get_distance_from_root(ca, token_b)
-                distance_ab = distance_a + distance_b
-                if distance_ab < distance:
-                    distance = distance_ab
-        return distance
+        returns: an integer distance, 10000 if the tokens are not in the same tree
+        """
+        path_a = [token_a.i] + self.get_ancestor_indices(token_a)
+        depth_b = {i: d for d, i in enumerate([token_b.i] + self.get_ancestor_indices(token_b))}
+        for d, i in enumerate(path_a):
+            if i in depth_b:
+                return d + depth_b[i]
+        return 10000
 
     def get_closest_contiguous_location_block(self, entity_list, root_node):
-        location_entity_tokens = [[token for token in sentence]
-                                  for sentence in entity_list]
-        token_list = [
-            item for sublist in location_entity_tokens for item in sublist]
-        location_tokens_by_distance = sorted([(token, self.get_distance_between_tokens(token, root_node))
-                                              for token in token_list], key=lambda x: x[1])
-        closest_location = location_tokens_by_distance[0]
+        """
+        Gets the location tokens closest to a node, together with the location tokens
+        that are their ancestors or descendents, repeatedly.
+        :param entity_list: a list of spans
+        :param root_node: a token
+
+        returns: a list of tokens
+        """
+        token_list = [token for entity in entity_list for token in entity]
+        if len(token_list) == 0:
+            return []
+        closest_location = min(token_list, key=lambda t: self.get_distance_between_tokens(t, root_node))
+        ancestors = {t.i: set(self.get_ancestor_indices(t)) for t in token_list}
         contiguous_block = [closest_location]
+        # indices of the tokens that are ancestors or descendents of the block
+        neighbours = ancestors[closest_location.i] | {t.i for t in closest_location.subtree}
+        block = {closest_location.i}
         added_tokens = 1
         while added_tokens > 0:
-            contiguous_block_ancestors = [[token for token in token_list if token.is_ancestor_of(toke)] for toke in
-                                          contiguous_block]
-            contiguous_block_subtrees = [
-                token.subtree for token in contiguous_block]
-            contiguous_block_neighbours = contiguous_block_ancestors + contiguous_block_subtrees
-            contiguous_block_neighbours = [
-                item for sublist in contiguous_block_neighbours for item in sublist]
             added_tokens = 0
             for toke in token_list:
-                if not self.check_if_collection_contains_token(toke, contiguous_block):
-                    if toke in contiguous_block_neighbours:
-                        added_tokens += 1
-                        contiguous_block.append(toke)
+                if toke.i not in block and toke.i in neighbours:
+                    added_tokens += 1
+                    contiguous_block.append(toke)
+                    block.add(toke.i)
+            for toke in contiguous_block[len(contiguous_block) - added_tokens:]:
+                neighbours |= ancestors[toke.i]
+                neighbours |= {t.i for t in toke.subtree}
         return contiguous_block
 
     def get_contiguous_tokens(self, token_list):
-        common_ancestor_tokens = self.get_common_ancestors(token_list)
-        highest_contiguous_block = []
-        for toke in token_list:
-            if self.check_if_collection_contains_token(toke.head, common_ancestor_tokens):
-                highest_contiguous_block.append(toke)
+        common_ancestors = self.get_common_ancestors(token_list)
+        highest_contiguous_block = [toke for toke in token_list if toke.head.i in common_ancestors]
+        block = {toke.i for toke in highest_contiguous_block}
         added_tokens = 1
         while added_tokens > 0:
             added_tokens = 0
             for toke in token_list:
-                if self.check_if_collection_contains_token(toke.head, highest_contiguous_block):
-                    if not self.check_if_collection_contains_token(toke, highest_contiguous_block):
-                        highest_contiguous_block.append(toke)
-                        added_tokens += 1
+                if toke.head.i in block and toke.i not in block:
+                    highest_contiguous_block.append(toke)
+                    block.add(toke.i)
+                    added_tokens += 1
         return highest_contiguous_block
 
     def match_entities_in_block(self, entities, token_block):
@@ -273,8 +370,7 @@ class Interpreter(object):
         if not root:
             root = sentence.root
         descendents = self.get_descendents(sentence, root)
-        location_entities = [e for e in self.nlp(
-            sentence.text).ents if e.label_ == "GPE"]
+        location_entities = [e for e in self.sentence_doc(sentence).ents if e.label_ == "GPE"]
         if len(location_entities) > 1:
             descendent_location_tokens = []
             for location_ent in location_entities:
@@ -334,6 +430,15 @@ class Interpreter(object):
         else:
             return False
 
+    def is_candidate_sentence(self, sentence):
+        """
+        Test if a sentence may contain a report, i.e. if any of its lemmas
+        can be matched by verb_relevance.
+        param: sentence     A Spacy Span
+        return: True or False
+        """
+        return any(token.lemma_ in self.trigger_lemmas for token in sentence)
+
     def process_sentence_new(self, sentence, locations_memory, story):
         """
         Extracts the main verbs from a sentence as a starting point
@@ -441,7 +546,7 @@ class Interpreter(object):
         search for quantity within preceding noun phrase
         """
         quantity = Fact(None)
-        noun_phrases = list(self.nlp(sentence.text).noun_chunks)
+        noun_phrases = list(self.sentence_doc(sentence).noun_chunks)
         # Case one - if the unit is a conjugated noun phrase,
         # look for numeric tokens descending from the root of the phrase.
         for i, np in enumerate(noun_phrases):
@@ -687,9 +792,9 @@ class Interpreter(object):
         return: An attribute of ReportTerm
         """
         reporting_term = reporting_term.split(" ")
-        reporting_term = [self.nlp(t)[0].lemma_ for t in reporting_term]
+        reporting_term = [self.word_lemma(t) for t in reporting_term]
         reporting_unit = reporting_unit.split(" ")
-        reporting_unit = [self.nlp(t)[0].lemma_ for t in reporting_unit]
+        reporting_unit = [self.word_lemma(t) for t in reporting_unit]
         if "refugee" in reporting_unit:
             return FactTerm.REFUGEE
         elif "asylum" in reporting_unit:
@@ -740,24 +845,74 @@ class Interpreter(object):
         Process a story one sentence at a time
         Returns a list of reports in the story
 
+        Parameters
+        ----------
+        story:      the article content:String, or its already parsed Doc
+        """
+        if not isinstance(story, Doc):
+            story = self.nlp(story)
+        sentences = list(story.sents)  # Split into sentences
+        processed_reports, locations_memory = self.process_sentences(story, sentences, [])
+        return list(set(processed_reports))
+
+    def process_article_chunked(self, story, chunk_size=20000):
+        """
+        Process a long story in chunks of about chunk_size characters, cut between
+        sentences, so that only one chunk is parsed at a time.
+        Returns a list of reports in the story, with offsets from the beginning of the story
+
         Parameters
         ----------
         story:      the article content:String
+        chunk_size: the number of characters parsed at a time
         """
         processed_reports = []
-        story = self.nlp(story)
-        sentences = list(story.sents)  # Split into sentences
-        # Keep a running track of the most recent locations found in articles
         locations_memory = []
+        start = 0
+        while start < len(story):
+            end = min(start + chunk_size, len(story))
+            chunk = self.nlp(story[start:end])
+            sentences = list(chunk.sents)
+            if end < len(story) and len(sentences) > 1:
+                # The last sentence may continue in the next chunk, process it there
+                next_start = sentences[-1].start_char
+                sentences = sentences[:-1]
+            else:
+                next_start = end - start
+            reports, locations_memory = self.process_sentences(chunk, sentences, locations_memory)
+            for report in reports:
+                shift_report(report, start)
+            processed_reports.extend(reports)
+            # The locations remembered must not refer to the chunk, which is discarded
+            locations_memory = [shift_fact(f, -next_start) for f in locations_memory]
+            start += next_start
+        return list(set(processed_reports))
+
+    def process_sentences(self, story, sentences, locations_memory):
+        """
+        Process sentences of a story one at a time
+        Returns a list of reports in the sentences, and the locations remembered at the end
+
+        Parameters
+        ----------
+        story:      the parsed article, a Doc
+        sentences:  the sentences of the story to process, a list of Spans
+        locations_memory:   the locations found most recently before the sentences, a list of Facts
+        """
+        processed_reports = []
+        # Keep a running track of the most recent locations found in articles
         for i, sentence in enumerate(sentences):  # Process sentence
             reports = []
-            reports = self.process_sentence_new(
-                sentence, locations_memory, story)
+            # Only search sentences that may contain a report, but look for
+            # locations in every sentence to keep the memory up to date
+            if self.is_candidate_sentence(sentence):
+                reports = self.process_sentence_new(
+                    sentence, locations_memory, story)
             current_locations = self.extract_locations(sentence)
             if current_locations:
                 locations_memory = current_locations
             processed_reports.extend(reports)
-        return list(set(processed_reports))
+        return processed_reports, locations_memory
 
 
 class Fact(object):
@@ -817,6 +972,27 @@ class Report(object):
         return rep
 
 
+def shift_fact(fact, offset):
+    """
+    Copy a Fact with its offsets moved by offset characters. The copy keeps the
+    text of the Fact instead of its token, so it does not refer to the Doc.
+    """
+    shifted = copy.copy(fact)
+    if fact.token is not None:
+        shifted.token = fact.text
+    shifted.start_idx += offset
+    shifted.end_idx += offset
+    return shifted
+
+
+def shift_report(report, offset):
+    """Move the offsets of a Report by offset characters"""
+    report.sentence_start += offset
+    report.sentence_end += offset
+    report.tag_spans = [dict(span, start=span['start'] + offset, end=span['end'] + offset)
+                        for span in report.tag_spans]
+
+
 def convert_quantity(value):
     '''Convert an extracted quantity to an integer.
     Solution forked from
@@ -0,0 +1,60 @@
+'''Lazy loading of the spaCy language model used by the pipeline stages.
+
+The model is loaded the first time a stage asks for it rather than when the
+modules are imported, so processes that never parse text (the API, setup, the
+scraper) do not pay for it. Each stage gets its own model: only the fact
+extraction adds the custom tokenizer cases, so the relevance features are
+computed on the tokenization the relevance model was trained with.
+'''
+import logging
+import resource
+import threading
+import time
+
+import spacy
+
+from idetect.interpreter import load_custom_tokenizer_cases
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'en_default'
+
+# Both stages use the whole pipeline: the relevance features need the entities
+# (GPEs), the dependency heads and the lemmas, as the fact extraction does
+STAGES = ('relevance', 'extraction')
+
+_models = {}
+_lock = threading.Lock()
+
+
+def max_rss_mb():
+    """Peak resident set size of the current process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_nlp(stage='extraction'):
+    '''Return the spaCy Language for a stage, loading it on first use
+    :params stage: one of STAGES
+    :return: a spaCy Language instance
+    '''
+    if stage not in STAGES:
+        raise ValueError("Unknown stage {}".format(stage))
+    with _lock:
+        nlp = _models.get(stage)
+        if nlp is None:
+            nlp = load_model(stage)
+            _models[stage] = nlp
+    return nlp
+
+
+def load_model(stage):
+    '''Load the spaCy model for a stage'''
+    start = time.time()
+    nlp = spacy.load(MODEL_NAME)
+    if stage == 'extraction':
+        load_custom_tokenizer_cases(nlp)
+    # Parses are only shared between users of the same stage's model, see parse_cache
+    nlp.stage = stage
+    logger.info("Loaded spaCy model {} for {} in {:.2f}s, max RSS {:.0f}MB".format(
+        MODEL_NAME, stage, time.time() - start, max_rss_mb()))
+    return nlp
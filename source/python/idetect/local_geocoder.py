@@ -0,0 +1,168 @@
+'''Offline geocoder backed by a SQLite index of a GeoNames dump.
+
+The index is built once with load_geonames.py from a GeoNames-style dump
+(allCountries.txt, cities1000.txt, ...: tab separated, with the name, ASCII
+name and alternate names, coordinates, feature class and code, country code
+and population of each place). It holds one row per place and one row per
+normalized name or alternate name of a place.
+
+Lookups return the most populous place with the given name, restricted to a
+country when one is given, in the same form as nominatim_coordinates.
+'''
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from idetect import gazetteer
+from idetect.model import LocationType
+
+logger = logging.getLogger(__name__)
+
+# Path of the SQLite index; when set, places are looked up there before Nominatim
+LOCAL_GEOCODER_INDEX = os.environ.get('LOCAL_GEOCODER_INDEX')
+# Whether places missing from the local index are looked up on Nominatim
+NOMINATIM_FALLBACK = os.environ.get('NOMINATIM_FALLBACK', 'True').lower() == 'true'
+
+# Columns of the GeoNames dump
+NAME, ASCII_NAME, ALTERNATE_NAMES, LATITUDE, LONGITUDE, FEATURE_CLASS, FEATURE_CODE, COUNTRY_CODE = range(1, 9)
+POPULATION = 14
+
+SCHEMA = '''
+CREATE TABLE places (
+    id INTEGER PRIMARY KEY,
+    latitude TEXT NOT NULL,
+    longitude TEXT NOT NULL,
+    feature_class TEXT,
+    feature_code TEXT,
+    country_iso3 TEXT,
+    population INTEGER NOT NULL
+);
+CREATE TABLE names (
+    name TEXT NOT NULL,
+    place_id INTEGER NOT NULL,
+    PRIMARY KEY (name, place_id)
+) WITHOUT ROWID;
+'''
+
+
+def feature_to_entity(feature_class, feature_code):
+    '''Map a GeoNames feature class and code to a LocationType'''
+    if feature_class == 'A':
+        if feature_code.startswith('PCL'):
+            return LocationType.COUNTRY
+        if feature_code.startswith('ADM'):
+            return LocationType.SUBDIVISION
+    elif feature_class == 'P':
+        if feature_code == 'PPLX':
+            return LocationType.NEIGHBORHOOD
+        return LocationType.CITY
+    elif feature_class == 'S':
+        return LocationType.ADDRESS
+    return LocationType.UNKNOWN
+
+
+def read_dump(f, min_population=0):
+    '''Yield the place rows and the normalized names of the places in a GeoNames dump'''
+    csv.field_size_limit(sys.maxsize)
+    for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+        population = int(row[POPULATION] or 0)
+        if population < min_population:
+            continue
+        names = {row[NAME], row[ASCII_NAME]}
+        names.update(n for n in row[ALTERNATE_NAMES].split(',') if n)
+        place = (int(row[0]), row[LATITUDE], row[LONGITUDE], row[FEATURE_CLASS], row[FEATURE_CODE],
+                 gazetteer.iso3_code(row[COUNTRY_CODE], None), population)
+        yield place, {gazetteer.normalize(n.strip()) for n in names if n.strip()}
+
+
+def build_index(dump_path, index_path, min_population=0, batch_size=10000):
+    '''Build the SQLite index at index_path from the GeoNames dump at dump_path.
+    Return the number of places indexed.
+    '''
+    if os.path.exists(index_path):
+        os.unlink(index_path)
+    connection = sqlite3.connect(index_path)
+    connection.executescript(SCHEMA)
+    places, names, count = [], [], 0
+    with open(dump_path, encoding='utf-8', newline='') as f:
+        for place, place_names in read_dump(f, min_population):
+            places.append(place)
+            names.extend((name, place[0]) for name in place_names)
+            if len(places) >= batch_size:
+                count += insert(connection, places, names)
+                places, names = [], []
+                logger.info("Indexed {} places".format(count))
+    count += insert(connection, places, names)
+    connection.commit()
+    connection.execute('VACUUM')
+    connection.close()
+    return count
+
+
+def insert(connection, places, names):
+    connection.executemany('INSERT INTO places VALUES (?, ?, ?, ?, ?, ?, ?)', places)
+    connection.executemany('INSERT OR IGNORE INTO names VALUES (?, ?)', names)
+    return len(places)
+
+
+class LocalGeocoder(object):
+    '''Look up places in a SQLite index built by build_index.
+    The index is opened read-only, once per thread.
+    '''
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect('file:{}?mode=ro'.format(self.index_path), uri=True)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def candidates(self, place_name, country_code='XXX', limit=2):
+        '''Return the places with this name, most populous first'''
+        query = ('SELECT p.latitude, p.longitude, p.feature_class, p.feature_code, p.country_iso3 '
+                 'FROM names n JOIN places p ON p.id = n.place_id WHERE n.name = ?')
+        params = [gazetteer.normalize(' '.join(place_name.split()))]
+        if country_code and country_code != 'XXX':
+            query += ' AND p.country_iso3 = ?'
+            params.append(country_code)
+        query += ' ORDER BY p.population DESC LIMIT ?'
+        params.append(limit)
+        return self.connection.execute(query, params).fetchall()
+
+    def geocode(self, place_name, country_code='XXX'):
+        '''Return the geo info of the most populous place with this name, in the
+        form returned by nominatim_coordinates, or None if there is none
+        '''
+        candidates = self.candidates(place_name, country_code)
+        if not candidates:
+            return None
+        latitude, longitude, feature_class, feature_code, iso3 = candidates[0]
+        return {
+            'place_name': place_name, 'type': feature_to_entity(feature_class, feature_code),
+            'country_code': iso3 or country_code,
+            'flag': 'multiple-results' if len(candidates) > 1 else 'single-result',
+            'coordinates': '{},{}'.format(latitude, longitude)
+        }
+
+
+_local_geocoder = None
+
+
+def get_local_geocoder():
+    '''Return the LocalGeocoder of LOCAL_GEOCODER_INDEX, or None if it is not set'''
+    global _local_geocoder
+    if _local_geocoder is None and LOCAL_GEOCODER_INDEX:
+        if not os.path.exists(LOCAL_GEOCODER_INDEX):
+            raise FileNotFoundError("Local geocoder index {} not found, build it with load_geonames.py"
+                                    .format(LOCAL_GEOCODER_INDEX))
+        _local_geocoder = LocalGeocoder(LOCAL_GEOCODER_INDEX)
+    return _local_geocoder
@@ -4,13 +4,13 @@ import re
 import string
 
 from sqlalchemy import Column, BigInteger, Integer, String, Date, DateTime, Boolean, \
-    Numeric, ForeignKey, Table, Index, Text, UniqueConstraint
+    Numeric, Float, ForeignKey, Table, Index, Text, UniqueConstraint, LargeBinary
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, object_session, relationship
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, select
 
 
 Base = declarative_base()
@@ -50,6 +50,7 @@ class Status:
     CLASSIFYING_FAILED = 'classifying failed'
     EXTRACTING_FAILED = 'extracting failed'
     GEOTAGGING_FAILED = 'geotagging failed'
+    NOT_RELEVANT = 'not relevant'
     EDITING = 'editing'
     EDITED = 'edited'
 
@@ -177,17 +178,25 @@ class Analysis(Base):
             except NoResultFound:
                 raise NotLatestException(self)
 
-            dict = {c.name: self.__getattribute__(c.name) for c in Analysis.__table__.columns}
-            history = AnalysisHistory(**dict)
-            history.facts = self.facts
-            session.add(history)
-
-            self.updated = func.now()
-            self.status = new_status
+            self.add_new_version(new_status)
             session.commit()
         finally:
             session.rollback()  # make sure we release the FOR UPDATE lock
 
+    def add_new_version(self, new_status):
+        """
+        Keep the current version of this article in the history and give it the new status,
+        without committing. The caller must hold the FOR UPDATE lock on this article.
+        """
+        session = object_session(self)
+        dict = {c.name: self.__getattribute__(c.name) for c in Analysis.__table__.columns}
+        history = AnalysisHistory(**dict)
+        history.facts = self.facts
+        session.add(history)
+
+        self.updated = func.now()
+        self.status = new_status
+
     def tagged_text(self):
         # Add tags to article content for display purposes
         spans = self.get_unique_tag_spans()
@@ -298,6 +307,56 @@ class DocumentContent(Base):
     content_clean = Column(String)
     content_type = Column(String)
     content_ts = Column(TSVECTOR)
+    parse = relationship('DocumentParse', uselist=False, back_populates='content',
+                         cascade='all, delete-orphan')
+
+
+class DocumentParse(Base):
+    """A serialized spaCy Doc of DocumentContent.content_clean, kept by the fact extraction when STORE_PARSES is set"""
+    __tablename__ = 'idetect_document_parses'
+
+    content_id = Column(Integer,
+                        ForeignKey('idetect_document_contents.id', ondelete="CASCADE"),
+                        primary_key=True)
+    content = relationship('DocumentContent', back_populates='parse')
+    parser = Column(String, nullable=False)  # identifies the spaCy pipeline that produced the parse
+    doc = Column(LargeBinary, nullable=False)
+    updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class ClassificationCache(Base):
+    """Category and relevance predicted for a document content by a given version of the models"""
+    __tablename__ = 'idetect_classification_cache'
+
+    content_hash = Column(String, primary_key=True)
+    model_version = Column(String, primary_key=True)
+    category = Column(String)
+    relevance = Column(Boolean)
+    created = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class GeocodeCache(Base):
+    """Result of geocoding a normalized place name, optionally within a country.
+    Failed and empty lookups are kept as well, with flag 'error' or 'no-results'."""
+    __tablename__ = 'idetect_geocode_cache'
+
+    place_name = Column(String, primary_key=True)
+    country_hint = Column(String(3), primary_key=True)
+    flag = Column(String, nullable=False)
+    location_type = Column(String)
+    country_iso3 = Column(String(3))
+    latlong = Column(String)
+    error_msg = Column(String)  # message of the failure, for flag 'error'
+    updated = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class RateLimit(Base):
+    """Token bucket shared by the processes calling a rate limited service"""
+    __tablename__ = 'idetect_rate_limits'
+
+    name = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
 
 class FactUnit:
@@ -352,6 +411,12 @@ class Fact(Base):
     analysis_date = Column(DateTime(timezone=True), server_default=func.now())
     locations = relationship('Location', secondary=fact_location, back_populates='facts')
 
+    @classmethod
+    def allocate_ids(cls, session, count):
+        """Reserve count ids for new Facts, so that their links can be inserted in bulk along with them"""
+        return [row[0] for row in session.execute(
+            select([func.nextval('idetect_facts_id_seq')]).select_from(func.generate_series(1, count)))]
+
 
 class Country(Base):
     __tablename__ = 'idetect_countries'
@@ -388,6 +453,28 @@ class Location(Base):
     facts = relationship('Fact', secondary=fact_location, back_populates='locations')
 
 
+class LocationStatus:
+    PENDING = 'pending'
+    GEOCODING = 'geocoding'
+    GEOCODED = 'geocoded'
+    FAILED = 'failed'
+
+
+class LocationQueue(Base):
+    """Location waiting to be geocoded, or geocoded, by run_location_geocoder"""
+    __tablename__ = 'idetect_location_queue'
+
+    location_id = Column(Integer, ForeignKey(Location.id, ondelete="CASCADE"), primary_key=True)
+    location = relationship(Location)
+    status = Column(String, nullable=False, server_default=LocationStatus.PENDING)
+    attempts = Column(Integer, nullable=False, server_default='0')
+    error_msg = Column(String)
+    updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+location_queue_status_index = Index('location_queue_status_updated', LocationQueue.status, LocationQueue.updated)
+
+
 class KeywordType:
     PERSON_TERM = 'person_term'
     PERSON_UNIT = 'person_unit'
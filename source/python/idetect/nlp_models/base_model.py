@@ -1,7 +1,10 @@
 import errno
 import fcntl
+import hashlib
+import logging
 import os
 import re
+import time
 import numpy as np
 import pandas as pd
 import requests
@@ -12,8 +15,21 @@ from scipy import sparse
 from gensim import matutils, models
 from gensim.sklearn_integration.sklearn_wrapper_gensim_lsimodel import SklLsiModel
 
+from idetect.language import max_rss_mb
 from idetect.geotagger import strip_accents, compare_strings, strip_words, LocationType, subdivision_country_code, match_country_name, city_subdivision_country
 
+logger = logging.getLogger(__name__)
+
+
+def file_digest(path):
+    """MD5 hex digest of a file's content"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class DownloadableModel(object):
     """A base class for loading pickeld scikit-learn models that may be stored
     locally or in online storage.
@@ -21,15 +37,23 @@ class DownloadableModel(object):
     Attributes:
         model (sklearn model): a scikit-learn Transformer, Estimator, or
             Pipeline, which has the "predict" method.
+        version (str): digest of the model file, which changes whenever a new
+            model is deployed.
     """
 
 #    def __init__(self, model_path, model_url):
 #        self.model = self.load_model(model_path, model_url)
 
+    # Models are re-dumped uncompressed next to the downloaded file and loaded with
+    # this mmap_mode, so that their arrays are shared through the page cache by all
+    # processes on a host instead of being copied into each one.
+    mmap_mode = 'r'
+    mmap_suffix = '.mmap'
+
     def load_model(self, model_path, model_url):
         """Obtains and loads a pickled scikit-learn model. Checks to see if
         the model exists at the specified directory and if not, downloads it
-        from a URL.
+        from a URL. The model is then loaded memory-mapped.
 
         Args:
             model_path (str): Path to a model's current location, or the
@@ -40,7 +64,24 @@ class DownloadableModel(object):
             model (sklearn model): An unpickled sklearn model (Transformer,
                 Estimator, or Pipeline).
         """
-        # Load users model if specified and exists
+        start = time.time()
+        self.download_model(model_path, model_url)
+        self.version = file_digest(model_path)
+        mmap_path = self.convert_model(model_path)
+        model = joblib.load(mmap_path, mmap_mode=self.mmap_mode)
+        logger.info("Loaded model {} in {:.2f}s, max RSS {:.0f}MB".format(
+            model_path, time.time() - start, max_rss_mb()))
+        return model
+
+    def download_model(self, model_path, model_url):
+        """Downloads a pickled model to model_path unless it is already there.
+
+        Args:
+            model_path (str): Path to a model's current location, or the
+                location to which it should be downloaded.
+            model_url (str): URL where a model lives in storage.
+        """
+        # Use users model if specified and exists
         if os.path.isfile(model_path):
             with open(model_path, 'rb') as f:
                 # get exclusive lock in case currently being downloaded by
@@ -48,8 +89,7 @@ class DownloadableModel(object):
                 try:
                     fcntl.flock(f, fcntl.LOCK_EX)
                     if os.path.getsize(model_path) > 0:
-                        model = joblib.load(model_path)
-                        return model
+                        return
                 except IOError as e:
                     if e.errno != errno.EAGAIN:
                         raise
@@ -76,8 +116,32 @@ class DownloadableModel(object):
                 fcntl.flock(f, fcntl.LOCK_EX)
             finally:
                 fcntl.flock(f, fcntl.LOCK_UN)
-        model = joblib.load(model_path)
-        return model
+
+    def convert_model(self, model_path):
+        """Re-dumps a pickled model without compression so that it can be
+        memory-mapped. The conversion is redone whenever the pickled model is
+        newer than the converted one.
+
+        Args:
+            model_path (str): Path to the pickled model.
+
+        Returns:
+            mmap_path (str): Path to the memory-mappable model.
+        """
+        mmap_path = model_path + self.mmap_suffix
+        with open(mmap_path + '.lock', 'w') as lock:
+            # only one worker converts, the others wait for it
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.isfile(mmap_path) or \
+                        os.path.getmtime(mmap_path) < os.path.getmtime(model_path):
+                    model = joblib.load(model_path)
+                    joblib.dump(model, mmap_path + '.tmp')
+                    # replace atomically so readers never see a partial file
+                    os.rename(mmap_path + '.tmp', mmap_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return mmap_path
 
     def predict(self, text):
         """ This method should be overwritten to fit the specific case of the
@@ -128,12 +192,31 @@ class CustomSklLsiModel(SklLsiModel):
         if self.gensim_model is None:
             raise NotFittedError("This model has not been fitted yet. Call 'fit' with appropriate arguments before using this method.")
 
-        # The input as array of array
-        # import pdb; pdb.set_trace()
-        # check = lambda x: [x] if isinstance(x[0], tuple) else x
-        # docs = check(docs)
         if sparse.issparse(docs):
-            docs = matutils.Sparse2Corpus(docs, documents_columns=False)
+            return self.transform_sparse(docs)
+        return self.transform_corpus(docs)
+
+    def transform_sparse(self, X):
+        """
+        Project a sparse matrix of documents, one per row, on the topics with a single
+        matrix multiplication. Gives the same result as transform_corpus: the topic
+        weights of each document that are larger than 1e-9 (gensim drops smaller
+        ones) are moved to the front of the row, and the rest is padded with 1e-12.
+        """
+        u = self.gensim_model.projection.u[:, :self.gensim_model.num_topics]
+        topics = np.asarray(X.astype(u.dtype) * u)
+        nonzero = np.abs(topics) > 1e-9
+        # a stable sort keeps the order of the topics that are kept
+        order = np.argsort(~nonzero, axis=1, kind='mergesort')
+        topics = topics[np.arange(topics.shape[0])[:, None], order]
+        topics[np.arange(topics.shape[1]) >= nonzero.sum(axis=1)[:, None]] = 1e-12
+        if topics.shape[1] < self.num_topics:
+            padding = np.full((topics.shape[0], self.num_topics - topics.shape[1]), 1e-12, dtype=topics.dtype)
+            topics = np.hstack([topics, padding])
+        return np.reshape(topics, (X.shape[0], self.num_topics))
+
+    def transform_corpus(self, docs):
+        """Project documents in BOW format on the topics one at a time"""
         X = [[] for i in range(0, len(docs))];
         for k,v in enumerate(docs):
             doc_topics = self.gensim_model[v]
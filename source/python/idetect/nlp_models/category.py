@@ -18,16 +18,23 @@ class CategoryModel(DownloadableModel):
     def predict(self, text):
         try:
             category = self.model.predict(pd.Series(text))[0]
-            if category == 'disaster':
-                return DisplacementType.DISASTER
-            elif category == 'conflict':
-                return DisplacementType.CONFLICT
-            else:
-                return DisplacementType.OTHER
+            return self.convert_category(category)
         except ValueError:
             # error can occur if empty text is passed to model
             raise
 
+    def predict_batch(self, texts):
+        categories = self.model.predict(pd.Series(texts))
+        return [self.convert_category(c) for c in categories]
+
+    def convert_category(self, category):
+        if category == 'disaster':
+            return DisplacementType.DISASTER
+        elif category == 'conflict':
+            return DisplacementType.CONFLICT
+        else:
+            return DisplacementType.OTHER
+
 
 class Tokenizer(TransformerMixin):
     def __init__(self, stop_words=None):
@@ -9,8 +9,10 @@ from spacy.tokens.token import Token
 
 from idetect.model import Relevance
 from idetect.nlp_models.base_model import DownloadableModel, CustomSklLsiModel
-from idetect.fact_extractor import nlp
-from idetect.geotagger import strip_accents, compare_strings, strip_words, LocationType, subdivision_country_code, match_country_name, city_subdivision_country
+from idetect.language import get_nlp
+from idetect import gazetteer
+from idetect.parse_cache import parse, reserve
+from idetect.geotagger import strip_accents, compare_strings, strip_words, LocationType, subdivision_country_code
 
 
 class RelevanceModel(DownloadableModel):
@@ -21,14 +23,23 @@ class RelevanceModel(DownloadableModel):
     def predict(self, text):
         try:
             relevance = self.model.predict(pd.Series(text))[0]
-            if relevance == 1:
-                return Relevance.DISPLACEMENT
-            elif relevance == 0:
-                return Relevance.NOT_DISPLACEMENT
+            return self.convert_relevance(relevance)
         except ValueError:
             # error can occur if empty text is passed to model
             raise
 
+    def predict_batch(self, texts):
+        # Each feature parses all the texts in turn, keep them all in memory
+        reserve(len(texts))
+        relevances = self.model.predict(pd.Series(texts))
+        return [self.convert_relevance(r) for r in relevances]
+
+    def convert_relevance(self, relevance):
+        if relevance == 1:
+            return Relevance.DISPLACEMENT
+        elif relevance == 0:
+            return Relevance.NOT_DISPLACEMENT
+
 
 class LocationProcessor(BaseEstimator, TransformerMixin):
     """Transformer that replaces all country and subdivisions
@@ -39,10 +50,8 @@ class LocationProcessor(BaseEstimator, TransformerMixin):
         tokens = []
         for token in text:
             if token.ent_type_ == 'GPE':
-                if match_country_name(token.text)[0]:
+                if gazetteer.match_country(token.text, exact=True)[0]:
                     tokens.append('Switzerland')
-                elif city_subdivision_country(token.text):
-                    tokens.append('Geneva')
                 else:
                     tokens.append('Geneva')
             elif token.like_num:
@@ -77,7 +86,7 @@ class LocationProcessor(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, texts, *args):
-        texts = [nlp(t) for t in texts]
+        texts = [parse(get_nlp('relevance'), t) for t in texts]
         texts = [self.tag_entities(t) for t in texts]
         texts = self.single_string(texts)
         return texts
@@ -136,7 +145,7 @@ class PhraseProcessor(BaseEstimator, TransformerMixin):
 
     def transform(self, texts, *args):
 #         import pdb; pdb.set_trace()
-        docs = [nlp(t) for t in texts]
+        docs = [parse(get_nlp('relevance'), t) for t in texts]
         phrases = [self.parse_phrases(d) for d in docs]
         joined = [self.join_phrases(p) for p in phrases]
         text = self.single_string(joined)
@@ -189,7 +198,7 @@ class POSProcessor(BaseEstimator, TransformerMixin):
         return strings
 
     def transform(self, texts, *args):
-        docs = [nlp(sent) for sent in texts]
+        docs = [parse(get_nlp('relevance'), sent) for sent in texts]
         docs = [self.tag_pos(d) for d in docs]
         docs = [self.remove_noise(d) for d in docs]
         lemmas = [self.get_lemmas(d) for d in docs]
@@ -0,0 +1,171 @@
+'''Method(s) for sharing a single spaCy parse of a document between steps.
+
+The relevance features all work on the cleaned content of a document. Rather
+than each of them running the full pipeline, the parse is done once and kept in
+memory for the other features.
+
+Each stage has its own pipeline (see language), so parses are only shared
+between users of the same pipeline: the relevance stage cannot reuse the parses
+of the fact extraction, nor the other way round. When STORE_PARSES is set, the
+fact extraction stores its parse alongside the DocumentContent, so that
+extracting the facts of the document again does not parse it again; stored
+parses are deleted PARSE_STORE_TTL_DAYS after they were last written.
+
+Parses of texts longer than LONG_TEXT_LENGTH are not stored, and only the last
+one is kept in memory; the fact extraction processes those texts in chunks.
+'''
+import os
+from collections import OrderedDict
+from datetime import timedelta
+
+from spacy import about
+from spacy.tokens import Doc
+from sqlalchemy.sql import func
+
+from idetect.model import DocumentParse
+
+# When set, the parses of the fact extraction are stored with the DocumentContent
+STORE_PARSES = os.environ.get('STORE_PARSES', 'False').lower() == 'true'
+# Days after which stored parses are deleted
+PARSE_STORE_TTL_DAYS = int(os.environ.get('PARSE_STORE_TTL_DAYS', '30'))
+
+# Minimum number of recently parsed texts kept in memory by each process, see reserve
+MAX_CACHED_DOCS = 16
+
+# Length of the texts whose parse is too big to keep more than one of
+LONG_TEXT_LENGTH = 100000
+
+_docs = OrderedDict()
+_max_docs = MAX_CACHED_DOCS
+_long_docs = {}
+
+
+def parser_version(nlp):
+    '''Identify the spaCy pipeline used for parsing, so that parses
+    are only reused by a compatible pipeline
+    :params nlp: a spaCy Language instance
+    :return: String
+    '''
+    meta = getattr(nlp, 'meta', None) or {}
+    return 'spacy-{}/{}-{}/{}'.format(about.__version__, meta.get('name', ''), meta.get('version', ''),
+                                      getattr(nlp, 'stage', ''))
+
+
+def reserve(count):
+    '''Keep at least count parses in memory, so that a batch of texts
+    parsed by one step is still in memory for the next one
+    '''
+    global _max_docs
+    _max_docs = max(_max_docs, count)
+
+
+def is_long(text):
+    '''Whether the parse of a text is too big to be stored or kept with the others'''
+    return len(text or '') > LONG_TEXT_LENGTH
+
+
+def recall(version, text):
+    '''Return the Doc of a text kept in memory, or None'''
+    key = (version, text)
+    if is_long(text):
+        return _long_docs.get(key)
+    return _docs.get(key)
+
+
+def remember(version, text, doc):
+    '''Keep a parsed Doc in memory, dropping the least recently used ones'''
+    key = (version, text)
+    if is_long(text):
+        _long_docs.clear()
+        _long_docs[key] = doc
+        return
+    _docs[key] = doc
+    _docs.move_to_end(key)
+    while len(_docs) > _max_docs:
+        _docs.popitem(last=False)
+
+
+def parse(nlp, text):
+    '''Parse a text, reusing the Doc if it was recently parsed in this process
+    :params nlp: a spaCy Language instance
+    :params text: a String
+    :return: a spaCy Doc
+    '''
+    version = parser_version(nlp)
+    doc = recall(version, text)
+    if doc is None:
+        doc = nlp(text)
+    remember(version, text, doc)
+    return doc
+
+
+def get_parse(content, nlp):
+    '''Return the parse of the cleaned content of a document.
+    Uses the parse stored with the DocumentContent if it was produced by the same
+    pipeline, otherwise parses the text and attaches the serialized Doc to the
+    content so that it is saved with the next commit of its session.
+    :params content: instance of DocumentContent
+    :params nlp: a spaCy Language instance
+    :return: a spaCy Doc
+    '''
+    version = parser_version(nlp)
+    doc = cached_parse(content, nlp, version)
+    if doc is None:
+        doc = nlp(content.content_clean)
+    store_parse(content, doc, version)
+    return doc
+
+
+def get_parses(contents, nlp, batch_size=16, n_threads=1):
+    '''Return the parses of the cleaned content of several documents, as get_parse.
+    The documents without a usable parse are parsed together with nlp.pipe.
+    :params contents: list of DocumentContent instances
+    :params nlp: a spaCy Language instance
+    :params batch_size: number of texts buffered by nlp.pipe
+    :params n_threads: number of threads used by nlp.pipe
+    :return: list of spaCy Docs
+    '''
+    version = parser_version(nlp)
+    reserve(len(contents))
+    docs = [cached_parse(content, nlp, version) for content in contents]
+    missing = [i for i, doc in enumerate(docs) if doc is None]
+    texts = (contents[i].content_clean for i in missing)
+    for i, doc in zip(missing, nlp.pipe(texts, batch_size=batch_size, n_threads=n_threads)):
+        docs[i] = doc
+    for content, doc in zip(contents, docs):
+        store_parse(content, doc, version)
+    return docs
+
+
+def cached_parse(content, nlp, version):
+    '''Return the parse of a document kept in memory or stored with it, or None'''
+    doc = recall(version, content.content_clean)
+    if doc is None and STORE_PARSES:
+        stored = content.parse
+        if stored is not None and stored.parser == version:
+            doc = Doc(nlp.vocab).from_bytes(stored.doc)
+    return doc
+
+
+def store_parse(content, doc, version):
+    '''Keep the parse in memory, and attach it to the content if STORE_PARSES
+    is set, unless it is already stored or the content is long
+    '''
+    remember(version, content.content_clean, doc)
+    if not STORE_PARSES or is_long(content.content_clean):
+        return
+    stored = content.parse
+    if stored is None:
+        content.parse = DocumentParse(parser=version, doc=doc.to_bytes())
+    elif stored.parser != version:
+        stored.parser = version
+        stored.doc = doc.to_bytes()
+
+
+def purge_document_parses(session):
+    '''Delete the stored parses written more than PARSE_STORE_TTL_DAYS ago'''
+    deleted = session.query(DocumentParse) \
+        .filter(DocumentParse.updated < func.now() - timedelta(days=PARSE_STORE_TTL_DAYS)) \
+        .delete(synchronize_session=False)
+    session.commit()
+    return deleted
@@ -0,0 +1,92 @@
+'''Cheap keyword prefilter run ahead of the relevance model.
+
+Articles that mention none of the fact keywords are marked as not relevant
+without parsing them or running the relevance model. A sample of the rejected
+articles is still run through the model to measure the recall of the prefilter.
+'''
+import logging
+import os
+import random
+
+from nltk.stem import PorterStemmer
+from nltk.tokenize import WordPunctTokenizer
+
+from idetect.model import FactKeyword, KeywordType
+
+logger = logging.getLogger(__name__)
+
+USE_RELEVANCE_PREFILTER = os.environ.get('USE_RELEVANCE_PREFILTER', 'False').lower() == 'true'
+# Fraction of rejected articles that are still run through the relevance model
+RELEVANCE_PREFILTER_AUDIT_RATE = float(os.environ.get('RELEVANCE_PREFILTER_AUDIT_RATE', '0.05'))
+# Number of articles between two reports of the prefilter statistics
+RELEVANCE_PREFILTER_REPORT_EVERY = 100
+
+TRIGGER_KEYWORD_TYPES = (KeywordType.PERSON_TERM, KeywordType.STRUCTURE_TERM,
+                         KeywordType.PERSON_UNIT, KeywordType.STRUCTURE_UNIT,
+                         KeywordType.ARTICLE_KEYWORD)
+
+
+class LexiconPrefilter(object):
+    """Decide whether an article may be relevant from the keywords it contains.
+
+    Parameters
+    ----------
+    keywords : list of keyword strings; a keyword of several words triggers
+        only if all of its words are present
+    audit_rate : fraction of rejected articles to check against the relevance model
+    """
+
+    def __init__(self, keywords, audit_rate=RELEVANCE_PREFILTER_AUDIT_RATE):
+        self.tokenizer = WordPunctTokenizer()
+        self.stemmer = PorterStemmer()
+        self.triggers = [frozenset(self.stems(k)) for k in keywords]
+        self.triggers = [t for t in self.triggers if t]
+        self.audit_rate = audit_rate
+        self.checked = 0
+        self.passed = 0
+        self.passed_relevant = 0
+        self.audited = 0
+        self.audited_relevant = 0
+
+    @classmethod
+    def from_session(cls, session, keyword_types=TRIGGER_KEYWORD_TYPES, **kwargs):
+        keywords = [k.description for k in session.query(FactKeyword)
+                    .filter(FactKeyword.keyword_type.in_(keyword_types)).all()]
+        return cls(keywords, **kwargs)
+
+    def stems(self, text):
+        tokens = self.tokenizer.tokenize(text.lower())
+        return {self.stemmer.stem(t) for t in tokens if t.isalpha()}
+
+    def is_candidate(self, text):
+        """Return True if the text contains at least one trigger keyword"""
+        stems = self.stems(text)
+        candidate = any(trigger <= stems for trigger in self.triggers)
+        self.checked += 1
+        if candidate:
+            self.passed += 1
+        if self.checked % RELEVANCE_PREFILTER_REPORT_EVERY == 0:
+            logger.info("Relevance prefilter: {}".format(self.stats()))
+        return candidate
+
+    def should_audit(self):
+        """Whether a rejected article should still go through the relevance model"""
+        return random.random() < self.audit_rate
+
+    def record(self, candidate, relevance):
+        """Record the relevance model's result for an article checked by the prefilter"""
+        if candidate:
+            self.passed_relevant += int(bool(relevance))
+        else:
+            self.audited += 1
+            self.audited_relevant += int(bool(relevance))
+
+    def stats(self):
+        """Return the hit rate of the prefilter and its recall estimated from the audited articles"""
+        rejected = self.checked - self.passed
+        hit_rate = self.passed / self.checked if self.checked else None
+        missed = self.audited_relevant * rejected / self.audited if self.audited else 0
+        relevant = self.passed_relevant + missed
+        recall = self.passed_relevant / relevant if relevant else None
+        return {'checked': self.checked, 'hit_rate': hit_rate,
+                'audited': self.audited, 'recall': recall}
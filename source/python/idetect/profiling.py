@@ -0,0 +1,70 @@
+'''Opt-in profiling of fact extraction.
+
+A Profiler records the number of calls and the cumulative time of chosen
+methods of an object, for the current article and for all articles so far.
+Times are inclusive: a method calling another profiled method counts the time
+of both.
+'''
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Profiler(object):
+    """Record call counts and cumulative times, per article and in total.
+
+    Attributes:
+        article (dict): name to [calls, seconds] for the current article
+        totals (dict): name to [calls, seconds] for all the finished articles
+        articles (int): number of finished articles
+    """
+
+    def __init__(self):
+        self.article = {}
+        self.totals = {}
+        self.articles = 0
+
+    def wrap(self, obj, names):
+        """Replace the given methods of obj by versions that are timed"""
+        for name in names:
+            setattr(obj, name, self.timed(name, getattr(obj, name)))
+
+    def timed(self, name, function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.measure(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def measure(self, name):
+        """Time the enclosed block under the given name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        stats = self.article.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def start_article(self):
+        self.article = {}
+
+    def end_article(self):
+        """Add the current article to the totals and return its stats"""
+        for name, (calls, seconds) in self.article.items():
+            stats = self.totals.setdefault(name, [0, 0.0])
+            stats[0] += calls
+            stats[1] += seconds
+        self.articles += 1
+        return self.article
+
+    def report(self, stats=None):
+        """Format stats, by default the totals, slowest first"""
+        if stats is None:
+            stats = self.totals
+        return ', '.join('{}: {} calls {:.3f}s'.format(name, calls, seconds)
+                         for name, (calls, seconds) in sorted(stats.items(), key=lambda s: -s[1][1]))
@@ -0,0 +1,83 @@
+'''Request rate limits shared by all the processes using the database.
+
+DatabaseRateLimiter keeps a token bucket in idetect_rate_limits: each request
+takes a token, tokens come back at the given rate, up to burst of them. The
+row is locked while it is updated, so all the workers on all the hosts draw
+from the same budget. When the database cannot be used, the limit is kept per
+process by LocalRateLimiter instead.
+'''
+import logging
+import threading
+import time
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import func
+
+from idetect.model import Session, RateLimit
+
+logger = logging.getLogger(__name__)
+
+
+class LocalRateLimiter(object):
+    '''Space the requests of this process at least 1 / rate seconds apart'''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class DatabaseRateLimiter(object):
+    '''Token bucket named name in the database, refilled at rate tokens per second'''
+
+    def __init__(self, name, rate, burst=1, engine=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.engine = engine
+        self.fallback = LocalRateLimiter(rate)
+
+    def acquire(self):
+        '''Wait until a request may be made'''
+        engine = self.engine or Session.kw.get('bind')
+        if engine is None:
+            return self.fallback.acquire()
+        while True:
+            try:
+                wait = self.take(engine)
+            except SQLAlchemyError as e:
+                logger.warning("Rate limit {} unavailable, limiting this process only: {}".format(self.name, e))
+                return self.fallback.acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def take(self, engine):
+        '''Take a token if there is one. Return 0 if so, or else the number of seconds until there is one'''
+        table = RateLimit.__table__
+        with engine.begin() as connection:
+            connection.execute(insert(table).values(name=self.name, tokens=self.burst).on_conflict_do_nothing())
+            tokens, elapsed = connection.execute(
+                select([table.c.tokens, func.extract('epoch', func.now() - table.c.updated)])
+                    .where(table.c.name == self.name)
+                    .with_for_update()
+            ).first()
+            tokens = min(self.burst, tokens + float(elapsed) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            connection.execute(table.update().where(table.c.name == self.name)
+                               .values(tokens=tokens, updated=func.now()))
+        return wait
@@ -0,0 +1,15 @@
+'''Articles of the fact extractor tests, also run by run_benchmark.py extraction'''
+
+FLASH_FLOOD = "It was early Saturday when a flash flood hit the area and washed away more than 500 houses"
+REFUGEES = "It was early Saturday when government troops entered the area and forced more than 20000 refugees to flee."
+EVICTED = "2000 people have been evicted from their homes in Bosnia"
+EVICTION = "ordered eviction for 2000 people from their homes in Bosnia"
+FORCED_EVICTION = "ordered forced eviction for 2000 people from their homes in Bosnia"
+FORCIBLY_EVICTED = "2000 people were forcibly evicted from their homes in Bosnia"
+SACKED = "last week 2000 people have been sacked from their homes in Nigeria"
+LONDON_FLOOD = ("It was early Saturday when a flash flood hit large parts of London and Middlesex "
+                "and washed away more than 500 houses")
+BOSNIA_FLOOD = "It was early Saturday when a flash flood hit large parts of Bosnia and washed away more than 500 houses"
+
+ARTICLES = [FLASH_FLOOD, REFUGEES, EVICTED, EVICTION, FORCED_EVICTION, FORCIBLY_EVICTED, SACKED,
+            LONDON_FLOOD, BOSNIA_FLOOD]
@@ -1,12 +1,19 @@
 import os
-from unittest import TestCase
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase, mock
 
 from sqlalchemy import create_engine
 
 from idetect.model import Base, Session, Status, Gkg, Analysis, DocumentContent, Country, Location, \
     FactTerm, FactKeyword
-from idetect.fact_extractor import extract_facts, process_location
+from idetect.fact_extractor import extract_facts, extract_facts_batch, process_location, get_interpreter, \
+    get_location_ids, clear_location_cache, remember_location_ids
+from idetect.language import get_nlp
 from idetect.load_data import load_countries, load_terms
+from idetect.parse_cache import get_parse, get_parses, parse, parser_version, purge_document_parses
+from idetect.profiling import Profiler
+from idetect.tests.articles import FLASH_FLOOD, REFUGEES, EVICTED, EVICTION, FORCED_EVICTION, \
+    FORCIBLY_EVICTED, SACKED, LONDON_FLOOD, BOSNIA_FLOOD
 
 
 class TestFactExtractor(TestCase):
@@ -25,6 +32,8 @@ class TestFactExtractor(TestCase):
 
     def tearDown(self):
         self.session.rollback()
+        # the ids of the locations are not kept between tests
+        clear_location_cache()
         for article in self.session.query(Gkg).all():
             self.session.delete(article)
         self.session.commit()
@@ -35,7 +44,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="It was early Saturday when a flash flood hit the area and washed away more than 500 houses")
+            content_clean=FLASH_FLOOD)
         self.session.add(content)
         self.session.commit()
         analysis.content_id = content.id
@@ -50,7 +59,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="It was early Saturday when government troops entered the area and forced more than 20000 refugees to flee.")
+            content_clean=REFUGEES)
         self.session.add(content)
         self.session.commit()
         analysis.content_id = content.id
@@ -64,7 +73,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="2000 people have been evicted from their homes in Bosnia")
+            content_clean=EVICTED)
         self.session.add(content)
         self.session.commit()
         analysis.content_id = content.id
@@ -78,7 +87,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="ordered eviction for 2000 people from their homes in Bosnia")
+            content_clean=EVICTION)
         self.session.add(content)
         self.session.commit()
         analysis.content_id = content.id
@@ -92,7 +101,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="ordered forced eviction for 2000 people from their homes in Bosnia")
+            content_clean=FORCED_EVICTION)
         self.session.add(content)
         self.session.commit()
         analysis.content_id = content.id
@@ -106,7 +115,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="2000 people were forcibly evicted from their homes in Bosnia")
+            content_clean=FORCIBLY_EVICTED)
         self.session.add(content)
         self.session.commit()
         analysis.content_id = content.id
@@ -120,7 +129,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="last week 2000 people have been sacked from their homes in Nigeria")
+            content_clean=SACKED)
         self.session.add(content)
         self.session.commit()
         analysis.content_id = content.id
@@ -134,7 +143,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="It was early Saturday when a flash flood hit large parts of London and Middlesex and washed away more than 500 houses")
+            content_clean=LONDON_FLOOD)
         self.session.add(content)
         self.session.commit()
         analysis.content_id = content.id
@@ -156,7 +165,7 @@ class TestFactExtractor(TestCase):
         analysis = Analysis(gkg=gkg, status=Status.NEW)
         self.session.add(analysis)
         content = DocumentContent(
-            content_clean="It was early Saturday when a flash flood hit large parts of Bosnia and washed away more than 500 houses")
+            content_clean=BOSNIA_FLOOD)
         self.session.add(content)
         location = Location(location_name='Bosnia')
         self.session.add(location)
@@ -168,3 +177,162 @@ class TestFactExtractor(TestCase):
         extracted_location = fact.locations[0]
         self.assertEqual(location.id, extracted_location.id)
 
+    @mock.patch('idetect.parse_cache.STORE_PARSES', True)
+    def test_stores_parse(self):
+        """Stores the parse of the content so later stages can reuse it"""
+        nlp = get_nlp('extraction')
+        gkg = Gkg()
+        analysis = Analysis(gkg=gkg, status=Status.NEW)
+        self.session.add(analysis)
+        content = DocumentContent(
+            content_clean=FLASH_FLOOD)
+        self.session.add(content)
+        self.session.commit()
+        analysis.content_id = content.id
+        self.session.commit()
+        extract_facts(analysis)
+        self.session.commit()
+        self.assertIsNotNone(content.parse)
+        self.assertEqual(parser_version(nlp), content.parse.parser)
+        doc = get_parse(content, nlp)
+        self.assertEqual(content.content_clean, doc.text)
+
+    def test_does_not_store_parse_by_default(self):
+        """Parses are only stored when STORE_PARSES is set"""
+        content = DocumentContent(
+            content_clean=FLASH_FLOOD)
+        self.session.add(content)
+        self.session.commit()
+        get_parse(content, get_nlp('extraction'))
+        self.session.commit()
+        self.assertIsNone(content.parse)
+
+    @mock.patch('idetect.parse_cache.STORE_PARSES', True)
+    def test_purge_document_parses(self):
+        """Stored parses are deleted once they are old"""
+        contents = [DocumentContent(content_clean="A flash flood hit the area."),
+                    DocumentContent(content_clean="More than 500 houses were washed away.")]
+        self.session.add_all(contents)
+        self.session.commit()
+        get_parses(contents, get_nlp('extraction'))
+        self.session.commit()
+        contents[0].parse.updated = datetime.now(timezone.utc) - timedelta(days=365)
+        self.session.commit()
+        self.assertEqual(1, purge_document_parses(self.session))
+        self.session.expire_all()
+        self.assertIsNone(contents[0].parse)
+        self.assertIsNotNone(contents[1].parse)
+
+    @mock.patch('idetect.parse_cache.STORE_PARSES', True)
+    @mock.patch('idetect.parse_cache.LONG_TEXT_LENGTH', 50)
+    def test_does_not_store_long_parse(self):
+        """The parse of a long content is not stored"""
+        nlp = get_nlp('extraction')
+        content = DocumentContent(
+            content_clean=FLASH_FLOOD)
+        self.session.add(content)
+        self.session.commit()
+        doc = get_parse(content, nlp)
+        self.session.commit()
+        self.assertEqual(content.content_clean, doc.text)
+        self.assertIsNone(content.parse)
+
+    def test_tokenizer_cases_only_for_extraction(self):
+        """The relevance features are not tokenized with the custom cases of the extraction"""
+        text = "twenty-five people were displaced"
+        self.assertEqual('twenty-five', get_nlp('extraction')(text)[0].lower_)
+        self.assertEqual('twenty', get_nlp('relevance')(text)[0].lower_)
+        self.assertNotEqual(parser_version(get_nlp('extraction')), parser_version(get_nlp('relevance')))
+        self.assertIsNot(parse(get_nlp('extraction'), text), parse(get_nlp('relevance'), text))
+
+    def test_reuses_interpreter(self):
+        """The Interpreter is only built again when the keywords change"""
+        nlp = get_nlp('extraction')
+        interpreter = get_interpreter(self.session, nlp)
+        self.assertIs(interpreter, get_interpreter(self.session, nlp))
+
+        self.session.add(FactKeyword(description='uprooted', keyword_type='person_term'))
+        self.session.commit()
+        interpreter2 = get_interpreter(self.session, nlp)
+        self.assertIsNot(interpreter, interpreter2)
+        self.assertIn(nlp('uprooted')[0].lemma_, interpreter2.person_term_lemmas)
+
+    def test_extract_facts_batch(self):
+        """Extracts facts for several analyses at once"""
+        texts = [FLASH_FLOOD, REFUGEES]
+        analyses = []
+        for text in texts:
+            analysis = Analysis(gkg=Gkg(), status=Status.NEW)
+            self.session.add(analysis)
+            content = DocumentContent(content_clean=text)
+            self.session.add(content)
+            self.session.commit()
+            analysis.content_id = content.id
+            self.session.commit()
+            analyses.append(analysis)
+        self.assertEqual({}, extract_facts_batch(analyses, batch_size=2))
+        self.assertEqual(1, len(analyses[0].facts))
+        self.assertEqual(FactTerm.REFUGEE, analyses[1].facts[0].term)
+
+    def test_profile_extract_facts_batch(self):
+        """Profiles each analysis of a batch, with a share of the batch parse"""
+        analyses = []
+        for text in (FLASH_FLOOD, REFUGEES):
+            content = DocumentContent(content_clean=text)
+            self.session.add(content)
+            self.session.commit()
+            analysis = Analysis(gkg=Gkg(), status=Status.NEW, content_id=content.id)
+            self.session.add(analysis)
+            self.session.commit()
+            analyses.append(analysis)
+        profiler = Profiler()
+        with mock.patch('idetect.fact_extractor.profiler', profiler):
+            self.assertEqual({}, extract_facts_batch(analyses, batch_size=2))
+        self.assertEqual(2, profiler.articles)
+        self.assertEqual(2, profiler.totals['parse'][0])
+
+    def test_extract_facts_chunked(self):
+        """Extracts the same facts with the same offsets from a long text processed in chunks"""
+        nlp = get_nlp('extraction')
+        interpreter = get_interpreter(self.session, nlp)
+        text = " ".join(["Heavy rains fell on Kerala on Monday.",
+                         "The flood hit the area and washed away more than 500 houses.",
+                         "Officials met in the capital."] * 20)
+        expected = interpreter.process_article_new(text)
+        reports = interpreter.process_article_chunked(text, chunk_size=200)
+        self.assertEqual(len(expected), len(reports))
+        key = lambda r: r.sentence_start
+        for e, r in zip(sorted(expected, key=key), sorted(reports, key=key)):
+            self.assertEqual((e.sentence_start, e.sentence_end), (r.sentence_start, r.sentence_end))
+            self.assertEqual(e.locations, r.locations)
+            self.assertEqual(e.quantity, r.quantity)
+            self.assertEqual(e.tag_spans, r.tag_spans)
+
+    def test_sentence_entities(self):
+        """Locations are found in each sentence parsed on its own, with offsets in the article"""
+        nlp = get_nlp('extraction')
+        interpreter = get_interpreter(self.session, nlp)
+        text = "Officials met on Monday. Heavy rains fell on Kerala and washed away more than 500 houses."
+        doc = nlp(text)
+        sentence = list(doc.sents)[1]
+        self.assertIs(interpreter.sentence_doc(sentence), interpreter.sentence_doc(sentence))
+        self.assertEqual(sentence.text, interpreter.sentence_doc(sentence).text)
+        locations = interpreter.extract_locations(sentence)
+        self.assertEqual(['Kerala'], [l.text for l in locations])
+        for location in locations:
+            self.assertEqual(location.text, text[location.start_idx:location.end_idx])
+
+    def test_location_cache(self):
+        """Location ids are remembered once committed"""
+        location = Location(location_name='Bosnia')
+        self.session.add(location)
+        self.session.commit()
+        self.assertEqual({'Bosnia': location.id}, get_location_ids(self.session, {'Bosnia'}))
+        remember_location_ids({'Bosnia': location.id})
+        self.session.delete(location)
+        self.session.commit()
+        # served from the cache
+        self.assertEqual({'Bosnia': location.id}, get_location_ids(self.session, {'Bosnia'}))
+        clear_location_cache()
+        ids = get_location_ids(self.session, {'Bosnia'})
+        self.assertNotEqual(location.id, ids['Bosnia'])
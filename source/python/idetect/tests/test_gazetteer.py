@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from idetect import gazetteer
+
+
+class TestGazetteer(TestCase):
+
+    def test_match_country(self):
+        self.assertEqual(gazetteer.match_country('France'), ('FRA', 'France'))
+        # official name maps to the name of the country
+        self.assertEqual(gazetteer.match_country('French Republic'), ('FRA', 'France'))
+        self.assertEqual(gazetteer.match_country('FRANCE'), ('FRA', 'France'))
+        self.assertEqual(gazetteer.match_country('france', exact=True), (None, None))
+        self.assertEqual(gazetteer.match_country('Geneva'), (None, None))
+
+    def test_match_country_alias(self):
+        # names from all_countries.csv, ignoring case
+        self.assertEqual(gazetteer.match_country('islamic republic of afghanistan')[0], 'AFG')
+        self.assertEqual(gazetteer.match_country('tanzania')[0], 'TZA')
+
+    def test_match_subdivision(self):
+        self.assertEqual(gazetteer.match_subdivision('Geneve'), ('CHE', 'Switzerland'))
+        self.assertEqual(gazetteer.match_subdivision('GENÈVE'), ('CHE', 'Switzerland'))
+        self.assertEqual(gazetteer.match_subdivision('xghijdshfkljdes'), (None, None))
+
+    def test_country_centroid(self):
+        self.assertEqual(gazetteer.country_centroid('AFG'), '33.93911,67.709953')
+        self.assertIsNone(gazetteer.country_centroid('XXX'))
+
+    def test_country_codes(self):
+        self.assertEqual(gazetteer.iso3_code('CH'), 'CHE')
+        self.assertEqual(gazetteer.iso3_code('ZZ'), 'XXX')
+        self.assertEqual(gazetteer.iso2_code('CHE'), 'CH')
@@ -0,0 +1,51 @@
+import time
+from unittest import TestCase, mock
+
+import requests
+
+from idetect.geo_external import NominatimClient, GeotagException
+from idetect.rate_limiter import LocalRateLimiter
+
+
+def response(status_code, json=None):
+    resp = mock.Mock(status_code=status_code, headers={})
+    resp.json.return_value = json
+    return resp
+
+
+class TestNominatimClient(TestCase):
+
+    def setUp(self):
+        self.client = NominatimClient(rate_limiter=LocalRateLimiter(1000), retries=2, backoff=0)
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_retries_transient_errors(self, get):
+        get.side_effect = [requests.ConnectionError(), response(503), response(200, [])]
+        self.assertEqual([], self.client.search({'q': 'Ruislip'}))
+        self.assertEqual(3, get.call_count)
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_gives_up(self, get):
+        get.side_effect = [response(429), requests.Timeout(), response(502)]
+        with self.assertRaises(GeotagException):
+            self.client.search({'q': 'Ruislip'})
+        self.assertEqual(3, get.call_count)
+
+    @mock.patch.object(requests.Session, 'get')
+    def test_does_not_retry_bad_requests(self, get):
+        resp = response(400)
+        resp.raise_for_status.side_effect = requests.HTTPError('400 Client Error')
+        get.return_value = resp
+        with self.assertRaises(GeotagException):
+            self.client.search({'q': 'Ruislip'})
+        self.assertEqual(1, get.call_count)
+
+
+class TestLocalRateLimiter(TestCase):
+
+    def test_spaces_requests(self):
+        limiter = LocalRateLimiter(20)
+        start = time.time()
+        for i in range(5):
+            limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.19)
@@ -1,4 +1,5 @@
 import os
+from datetime import datetime, timedelta, timezone
 from unittest import TestCase, mock
 
 from sqlalchemy import create_engine
@@ -6,7 +7,10 @@ from sqlalchemy import create_engine
 from idetect.model import Base, Session, Status, Gkg, Analysis, DocumentContent, Country, Location, LocationType, Fact
 from idetect.load_data import load_countries
 from idetect.fact_extractor import extract_facts
-from idetect.geotagger import get_geo_info, process_locations, nominatim_coordinates, GeotagException
+from idetect.geotagger import get_geo_info, process_locations, nominatim_coordinates, GeotagException, \
+    enqueue_locations, locations_geocoded, geocode_location, process_locations_batch
+from idetect.model import LocationQueue, LocationStatus
+from idetect.worker import LocationWorker
 
 
 class TestGeoTagger(TestCase):
@@ -19,6 +23,7 @@ class TestGeoTagger(TestCase):
         Session.configure(bind=engine)
         Base.metadata.drop_all(engine)
         Base.metadata.create_all(engine)
+        self.engine = engine
         self.session = Session()
         load_countries(self.session)
 
@@ -147,3 +152,105 @@ class TestGeoTagger(TestCase):
             process_locations(analysis)
 
 
+
+    @mock.patch('idetect.geotagger.nominatim_coordinates')
+    def test_caches_geocoding(self, nominatim):
+        """Repeated lookups of a place, including failed ones, are answered from the cache"""
+        nominatim.return_value = {'place_name': 'Ruislip', 'type': LocationType.NEIGHBORHOOD,
+                                  'country_code': 'GBR', 'flag': 'single-result',
+                                  'coordinates': '51.5735,-0.4213'}
+        results = get_geo_info("Ruislip", self.session)
+        self.assertEqual(results['country_code'], 'GBR')
+        results = get_geo_info(" ruislip ", self.session)
+        self.assertEqual(results['coordinates'], '51.5735,-0.4213')
+        self.assertEqual(1, nominatim.call_count)
+
+        nominatim.return_value = {'place_name': 'xghijdshfkljdes', 'type': '', 'country_code': 'XXX',
+                                  'flag': 'no-results', 'coordinates': ''}
+        get_geo_info("xghijdshfkljdes", self.session)
+        results = get_geo_info("xghijdshfkljdes", self.session)
+        self.assertEqual(results['flag'], 'no-results')
+        self.assertEqual(2, nominatim.call_count)
+
+        nominatim.side_effect = GeotagException("Nominatim unavailable")
+        for i in range(2):
+            with self.assertRaisesRegex(GeotagException, "Nominatim unavailable"):
+                get_geo_info("Uxbridge", self.session)
+        self.assertEqual(3, nominatim.call_count)
+
+    @mock.patch('idetect.geotagger.nominatim_coordinates')
+    def test_location_queue(self, nominatim):
+        """Locations are geocoded once each, before their analyses are geotagged"""
+        nominatim.return_value = {'place_name': 'Ruislip', 'type': LocationType.NEIGHBORHOOD,
+                                  'country_code': 'GBR', 'flag': 'single-result',
+                                  'coordinates': '51.5735,-0.4213'}
+        location = Location(location_name="Ruislip")
+        for gkg_id in (3771256, 3771257):
+            gkg = Gkg(id=gkg_id, gkgrecordid="20170215174500-{}".format(gkg_id), date=20170215174500,
+                      document_identifier="http://www.example.com/{}".format(gkg_id))
+            self.session.add(gkg)
+            analysis = Analysis(gkg=gkg, status=Status.EXTRACTED)
+            self.session.add(analysis)
+            fact = Fact(unit='person', term='displaced')
+            fact.locations.append(location)
+            analysis.facts.append(fact)
+        self.session.commit()
+        ready = locations_geocoded(self.session.query(Analysis))
+        self.assertEqual(0, ready.count())
+
+        self.assertEqual(1, enqueue_locations(self.session))
+        self.assertEqual(0, enqueue_locations(self.session))
+        worker = LocationWorker(enqueue_locations, geocode_location, self.engine, max_sleep=1)
+        self.assertEqual(1, worker.work_all())
+        self.assertEqual(1, nominatim.call_count)
+
+        self.session.expire_all()
+        self.assertEqual('GBR', location.country_iso3)
+        entry = self.session.query(LocationQueue).one()
+        self.assertEqual(LocationStatus.GEOCODED, entry.status)
+        self.assertEqual(2, ready.count())
+
+    def test_location_queue_retry(self):
+        """Locations that failed every attempt are queued again after a while"""
+        location = Location(location_name="Ruislip")
+        self.session.add(location)
+        self.session.commit()
+        entry = LocationQueue(location_id=location.id, status=LocationStatus.FAILED, attempts=3)
+        self.session.add(entry)
+        self.session.commit()
+        self.assertEqual(0, enqueue_locations(self.session))
+
+        entry.updated = datetime.now(timezone.utc) - timedelta(days=2)
+        self.session.commit()
+        self.assertEqual(1, enqueue_locations(self.session))
+        self.session.expire_all()
+        self.assertEqual(LocationStatus.PENDING, entry.status)
+        self.assertEqual(0, entry.attempts)
+
+    @mock.patch('idetect.geotagger.nominatim_coordinates')
+    def test_process_locations_batch(self, nominatim):
+        """Geocodes each location of a batch once and splits the facts of all the analyses"""
+        nominatim.return_value = {'place_name': 'Ruislip', 'type': LocationType.NEIGHBORHOOD,
+                                  'country_code': 'GBR', 'flag': 'single-result',
+                                  'coordinates': '51.5735,-0.4213'}
+        ruislip = Location(location_name="Ruislip")
+        india = self.session.query(Location).filter(Location.location_name == 'India').one()
+        analyses = []
+        for gkg_id in (3771256, 3771257):
+            gkg = Gkg(id=gkg_id, gkgrecordid="20170215174500-{}".format(gkg_id), date=20170215174500,
+                      document_identifier="http://www.example.com/{}".format(gkg_id))
+            self.session.add(gkg)
+            analysis = Analysis(gkg=gkg, status=Status.EXTRACTED)
+            self.session.add(analysis)
+            fact = Fact(unit='person', term='displaced')
+            fact.locations.extend([ruislip, india])
+            analysis.facts.append(fact)
+            analyses.append(analysis)
+        self.session.commit()
+
+        self.assertEqual({}, process_locations_batch(analyses))
+        self.assertEqual(1, nominatim.call_count)
+        for analysis in analyses:
+            self.assertEqual(['GBR', 'IND'], sorted(f.iso3 for f in analysis.facts))
+            for fact in analysis.facts:
+                self.assertEqual([fact.iso3], [l.country_iso3 for l in fact.locations])
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from idetect.inference import InferenceServer, InferenceClient, InferenceException, RemoteModel
+
+
+class UpperModel(object):
+    """Stand-in model recording the size of each batch it predicts"""
+
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, text):
+        if not text:
+            raise ValueError("empty text")
+        return text.upper()
+
+    def predict_batch(self, texts):
+        self.batches.append(len(texts))
+        return [self.predict(t) for t in texts]
+
+
+class TestInference(TestCase):
+
+    def setUp(self):
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'inference.sock')
+        self.model = UpperModel()
+        self.server = InferenceServer(self.socket_path, {'upper': self.model}, batch_window=0.2)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(self.socket_path)
+
+    def test_predict(self):
+        model = RemoteModel(InferenceClient(self.socket_path), 'upper')
+        self.assertEqual('FLOOD', model.predict('flood'))
+
+    def test_batches_concurrent_requests(self):
+        results = {}
+
+        def predict(text):
+            results[text] = RemoteModel(InferenceClient(self.socket_path), 'upper').predict(text)
+
+        threads = [threading.Thread(target=predict, args=(t,)) for t in ('a', 'b', 'c', 'd')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual({'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D'}, results)
+        self.assertLess(len(self.model.batches), 4)
+
+    def test_concurrent_requests_on_one_client(self):
+        client = InferenceClient(self.socket_path)
+        texts = ['text {}'.format(i) for i in range(20)]
+        results = {}
+
+        def predict(text):
+            results[text] = client.predict('upper', text)
+
+        threads = [threading.Thread(target=predict, args=(t,)) for t in texts]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual({t: t.upper() for t in texts}, results)
+
+    def test_keeps_version_until_reconnect(self):
+        self.model.version = '1'
+        client = InferenceClient(self.socket_path)
+        model = RemoteModel(client, 'upper')
+        self.assertEqual('1', model.version)
+        self.model.version = '2'
+        self.assertEqual('1', model.version)
+        client.close()
+        client.predict('upper', 'flood')
+        self.assertEqual('2', model.version)
+
+    def test_errors(self):
+        client = InferenceClient(self.socket_path)
+        with self.assertRaises(InferenceException):
+            client.predict('upper', '')
+        with self.assertRaises(InferenceException):
+            client.predict('missing', 'flood')
+        # the connection is still usable after an error
+        self.assertEqual('FLOOD', client.predict('upper', 'flood'))
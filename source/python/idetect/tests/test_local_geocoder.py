@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from idetect.local_geocoder import LocalGeocoder, build_index
+from idetect.model import LocationType
+
+# geonameid, name, asciiname, alternatenames, latitude, longitude, feature class, feature code,
+# country code, cc2, admin1, admin2, admin3, admin4, population, elevation, dem, timezone, modification date
+DUMP = [
+    ['2643743', 'London', 'London', 'Londres,Londra', '51.50853', '-0.12574', 'P', 'PPLC', 'GB', '', 'ENG', 'GLA',
+     '', '', '7556900', '', '25', 'Europe/London', '2017-07-30'],
+    ['6058560', 'London', 'London', '', '42.98339', '-81.23304', 'P', 'PPL', 'CA', '', '08', '', '', '', '346765',
+     '', '252', 'America/Toronto', '2017-04-05'],
+    ['2657356', 'Ruislip', 'Ruislip', '', '51.57344', '-0.42341', 'P', 'PPLX', 'GB', '', 'ENG', 'GLA', '', '', '0',
+     '', '45', 'Europe/London', '2017-06-12'],
+    ['3042142', 'Genève', 'Geneve', 'Geneva,Genf', '46.2', '6.15', 'A', 'ADM1', 'CH', '', 'GE', '', '', '',
+     '453000', '', '400', 'Europe/Zurich', '2017-06-12'],
+]
+
+
+class TestLocalGeocoder(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        dump_path = os.path.join(self.directory, 'dump.txt')
+        with open(dump_path, 'w', encoding='utf-8') as f:
+            for row in DUMP:
+                f.write('\t'.join(row) + '\n')
+        self.index_path = os.path.join(self.directory, 'geonames.sqlite')
+        self.assertEqual(4, build_index(dump_path, self.index_path))
+        self.geocoder = LocalGeocoder(self.index_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ranks_by_population(self):
+        results = self.geocoder.geocode('London')
+        self.assertEqual(results['country_code'], 'GBR')
+        self.assertEqual(results['coordinates'], '51.50853,-0.12574')
+        self.assertEqual(results['type'], LocationType.CITY)
+        self.assertEqual(results['flag'], 'multiple-results')
+
+    def test_country_hint(self):
+        results = self.geocoder.geocode('London', 'CAN')
+        self.assertEqual(results['coordinates'], '42.98339,-81.23304')
+        self.assertEqual(results['flag'], 'single-result')
+        self.assertIsNone(self.geocoder.geocode('Ruislip', 'CAN'))
+
+    def test_alternate_names(self):
+        self.assertEqual(self.geocoder.geocode('londres')['country_code'], 'GBR')
+        results = self.geocoder.geocode('GENEVE')
+        self.assertEqual(results['type'], LocationType.SUBDIVISION)
+        self.assertEqual(results['country_code'], 'CHE')
+
+    def test_not_found(self):
+        self.assertIsNone(self.geocoder.geocode('xghijdshfkljdes'))
@@ -0,0 +1,27 @@
+from unittest import TestCase
+
+import numpy as np
+from gensim import matutils
+from scipy import sparse
+
+from idetect.nlp_models.base_model import CustomSklLsiModel
+
+
+class TestCustomSklLsiModel(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = sparse.random(40, 200, density=0.05, format='csr', random_state=rng)
+        # gensim infers the number of terms from the largest one used
+        self.X[0, 199] = 1.0
+        self.model = CustomSklLsiModel(num_topics=10).fit(self.X)
+
+    def test_transform_matches_corpus(self):
+        """The vectorized transform gives the same result as transforming one document at a time"""
+        X = sparse.vstack([self.X, sparse.csr_matrix((1, 200))]).tocsr()
+        expected = self.model.transform_corpus(matutils.Sparse2Corpus(X, documents_columns=False))
+        result = self.model.transform(X)
+        self.assertEqual(result.shape, (41, 10))
+        np.testing.assert_allclose(result, expected, rtol=1e-9, atol=1e-12)
+        # the empty document is all padding
+        np.testing.assert_array_equal(result[-1], np.full(10, 1e-12))
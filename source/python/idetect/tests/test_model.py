@@ -1,12 +1,27 @@
 import os
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
 from unittest import TestCase
 
 import dateutil.parser
 from sqlalchemy import create_engine
 
+from idetect.classifier import classify, purge_classification_cache
 from idetect.model import Base, Session, Status, Gkg, \
-    Analysis, DocumentContent, NotLatestException, AnalysisHistory, Country, CountryTerm, Location, LocationType, Fact
+    Analysis, DocumentContent, NotLatestException, AnalysisHistory, Country, CountryTerm, Location, LocationType, Fact, \
+    ClassificationCache, DisplacementType, Relevance
+
+
+class CountingModel(object):
+    """Stand-in classifier model counting its predictions"""
+
+    def __init__(self, result, version):
+        self.result = result
+        self.version = version
+        self.calls = 0
+
+    def predict(self, text):
+        self.calls += 1
+        return self.result
 
 
 class TestModel(TestCase):
@@ -189,3 +204,38 @@ class TestModel(TestCase):
 
         self.assertEqual(yangon.country, myanmar.country)
         self.assertEqual(yangon.country, burma.country)
+
+    def test_purge_classification_cache(self):
+        old = datetime.now(timezone.utc) - timedelta(days=365)
+        self.session.add_all([
+            ClassificationCache(content_hash='a', model_version='v1', created=old),
+            ClassificationCache(content_hash='b', model_version='v1'),
+            ClassificationCache(content_hash='c', model_version='v2', created=old),
+        ])
+        self.session.commit()
+        self.assertEqual(1, purge_classification_cache(self.session, 'v2'))
+        self.assertEqual({('b', 'v1'), ('c', 'v2')},
+                         {(c.content_hash, c.model_version) for c in self.session.query(ClassificationCache)})
+
+    def test_classify_cached(self):
+        content = DocumentContent(content="Floods displaced 500 people", content_clean="Floods displaced 500 people")
+        self.session.add(content)
+        self.session.commit()
+        analyses = [Analysis(gkg_id=gkg_id, status=Status.CLASSIFYING, content_id=content.id)
+                    for gkg_id in (3771256, 3771257)]
+        self.session.add_all(analyses)
+        self.session.commit()
+        category_model = CountingModel(DisplacementType.DISASTER, 'c1')
+        relevance_model = CountingModel(Relevance.DISPLACEMENT, 'r1')
+
+        classify(analyses[0], category_model, relevance_model)
+        classify(analyses[1], category_model, relevance_model)
+        self.assertEqual((1, 1), (category_model.calls, relevance_model.calls))
+        self.assertEqual((DisplacementType.DISASTER, Relevance.DISPLACEMENT),
+                         (analyses[1].category, analyses[1].relevance))
+
+        # a new version of either model does not use the results of the previous one
+        relevance_model.version = 'r2'
+        classify(analyses[1], category_model, relevance_model)
+        self.assertEqual((2, 2), (category_model.calls, relevance_model.calls))
+        self.assertEqual(2, self.session.query(ClassificationCache).count())
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from idetect.prefilter import LexiconPrefilter
+
+
+class TestPrefilter(TestCase):
+
+    def setUp(self):
+        self.prefilter = LexiconPrefilter(['displaced', 'houses', 'relief camp'], audit_rate=0)
+
+    def test_candidate(self):
+        """Passes articles mentioning a keyword in any inflection"""
+        self.assertTrue(self.prefilter.is_candidate("The flood displaced thousands."))
+        self.assertTrue(self.prefilter.is_candidate("A storm destroyed 500 HOUSES"))
+
+    def test_not_candidate(self):
+        """Rejects articles without keywords"""
+        self.assertFalse(self.prefilter.is_candidate("The team won the final on Sunday."))
+
+    def test_phrase_keyword(self):
+        """Requires all words of a keyword phrase"""
+        self.assertFalse(self.prefilter.is_candidate("They set up camp by the river."))
+        self.assertTrue(self.prefilter.is_candidate("Families moved to a relief camp."))
+
+    def test_stats(self):
+        """Reports hit rate and recall estimated from audited articles"""
+        self.prefilter.is_candidate("The flood displaced thousands.")
+        self.prefilter.record(True, True)
+        self.prefilter.is_candidate("The team won the final on Sunday.")
+        self.prefilter.is_candidate("Prices rose again.")
+        self.prefilter.record(False, True)
+        stats = self.prefilter.stats()
+        self.assertEqual(3, stats['checked'])
+        self.assertAlmostEqual(1 / 3, stats['hit_rate'])
+        self.assertAlmostEqual(1 / 3, stats['recall'])
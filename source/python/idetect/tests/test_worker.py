@@ -2,14 +2,15 @@ import errno
 import logging
 import os
 import random
+import threading
 import time
 from datetime import datetime, timedelta
 from unittest import TestCase
 
 from sqlalchemy import create_engine, func
 
-from idetect.model import Base, Session, Status, Gkg, Analysis
-from idetect.worker import Worker, Initiator
+from idetect.model import Base, Session, Status, Gkg, Analysis, AnalysisHistory
+from idetect.worker import Worker, BatchWorker, Initiator
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -160,6 +161,79 @@ class TestWorker(TestCase):
         self.assertFalse(worker1.work(), "Worker1 found work")
         self.assertFalse(worker2.work(), "Worker2 found work")
 
+    def test_work_routed(self):
+        """success_status can be a function choosing the status from the Analysis"""
+        def classify_fn(analysis):
+            analysis.relevance = False
+
+        def route(analysis):
+            return Status.CLASSIFIED if analysis.relevance else Status.NOT_RELEVANT
+
+        worker = Worker(lambda query: query.filter(Analysis.status == Status.SCRAPED),
+                        Status.CLASSIFYING, route, Status.CLASSIFYING_FAILED,
+                        classify_fn, self.engine)
+        gkg = Gkg(
+            document_identifier="http://www.cnn.com/2013/08/23/us/hurricane-katrina-statistics-fast-facts/index.html")
+        analysis = Analysis(gkg=gkg, status=Status.SCRAPED)
+        self.session.add(analysis)
+        self.session.commit()
+        self.assertTrue(worker.work(), "Worker didn't find work")
+
+        analysis2 = analysis.get_updated_version()
+        self.assertEqual(analysis2.status, Status.NOT_RELEVANT)
+        self.assertFalse(analysis2.relevance)
+
+    def test_batch_work(self):
+        """A BatchWorker processes several analyses at once, failing only those the function reports"""
+        def batch_fn(analyses):
+            return {analyses[0]: RuntimeError("Nope")}
+
+        worker = BatchWorker(scraping_filter, Status.SCRAPING, Status.SCRAPED, Status.SCRAPING_FAILED,
+                             batch_fn, self.engine, batch_size=2)
+        for i in range(3):
+            gkg = Gkg(
+                document_identifier="http://www.cnn.com/2013/08/23/us/hurricane-katrina-statistics-fast-facts/index.html")
+            analysis = Analysis(gkg=gkg, status=Status.NEW)
+            self.session.add(analysis)
+            self.session.commit()
+        self.assertTrue(worker.work(), "Worker didn't find work")
+
+        self.assertEqual(self.session.query(Analysis).filter(Analysis.status == Status.SCRAPING_FAILED).count(), 1)
+        self.assertEqual(self.session.query(Analysis).filter(Analysis.status == Status.SCRAPED).count(), 1)
+        self.assertEqual(self.session.query(Analysis).filter(Analysis.status == Status.NEW).count(), 1)
+        failed = self.session.query(Analysis).filter(Analysis.status == Status.SCRAPING_FAILED).one()
+        self.assertIn("Nope", failed.error_msg)
+
+    def test_batch_work_race(self):
+        """BatchWorkers claiming at the same time never process the same analysis twice"""
+        processed = []
+
+        def batch_fn(analyses):
+            processed.extend(analysis.gkg_id for analysis in analyses)
+            time.sleep(0.01)
+
+        workers = [BatchWorker(scraping_filter, Status.SCRAPING, Status.SCRAPED, Status.SCRAPING_FAILED,
+                               batch_fn, self.engine, batch_size=5) for i in range(4)]
+        n = 40
+        for i in range(n):
+            gkg = Gkg(
+                document_identifier="http://www.cnn.com/2013/08/23/us/hurricane-katrina-statistics-fast-facts/index.html")
+            analysis = Analysis(gkg=gkg, status=Status.NEW)
+            self.session.add(analysis)
+            self.session.commit()
+        threads = [threading.Thread(target=worker.work_all) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(n, len(processed))
+        self.assertEqual(n, len(set(processed)))
+        self.assertEqual(self.session.query(Analysis).filter(Analysis.status == Status.SCRAPED).count(), n)
+        # one version in the history for claiming each analysis, and one for processing it
+        self.assertEqual(self.session.query(AnalysisHistory).filter(AnalysisHistory.gkg_id.in_(processed)).count(),
+                         2 * n)
+
     def test_work_all(self):
         worker = Worker(scraping_filter, Status.SCRAPING, Status.SCRAPED, Status.SCRAPING_FAILED,
                         TestWorker.nap_fn, self.engine)
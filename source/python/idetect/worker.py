@@ -6,7 +6,7 @@ import signal
 import time
 from multiprocessing import Process
 
-from idetect.model import Analysis, Session, Gkg, Status
+from idetect.model import Analysis, Session, Gkg, Status, LocationQueue, LocationStatus
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +18,8 @@ class Worker:
         Create a Worker that looks for Analyses with a given status. When it finds one, it marks it with
         working_status and runs a function. If the function returns without an exception, it advances the Analysis to
         success_status. If the function raises an exception, it advances the Analysis to failure_status.
+        success_status may also be a function of the Analysis returning the status, to route Analyses depending on
+        the result of the function.
         """
         self.filter_function = filter_function
         self.working_status = working_status
@@ -74,11 +76,14 @@ class Worker:
             # actually run the work function on this analysis
             self.function(analysis)
             delta = time.time() - start
+            success_status = self.success_status
+            if callable(success_status):
+                success_status = success_status(analysis)
             logger.info("Worker {} processed Analysis {} {} -> {} {}s".format(
-                os.getpid(), analysis.gkg_id, analysis_status, self.success_status, delta))
+                os.getpid(), analysis.gkg_id, analysis_status, success_status, delta))
             analysis.error_msg = None
             analysis.processing_time = delta
-            analysis.create_new_version(self.success_status)
+            analysis.create_new_version(success_status)
         except Exception as e:
             delta = time.time() - start
             logger.warning(
@@ -130,6 +135,162 @@ class Worker:
         return processes
 
 
+class BatchWorker(Worker):
+    def __init__(self, filter_function, working_status, success_status, failure_status, function, engine,
+                 max_sleep=60, timeout_seconds=300, batch_size=16):
+        """
+        Create a Worker that claims up to batch_size Analyses at a time and runs a function on the list of them.
+        The function returns a dict of the Analyses it failed to process to the exception raised for each; those
+        are advanced to failure_status and the others to success_status. If the function raises an exception, all
+        the Analyses of the batch are advanced to failure_status. timeout_seconds applies to the whole batch.
+        """
+        super().__init__(filter_function, working_status, success_status, failure_status, function, engine,
+                         max_sleep, timeout_seconds)
+        self.batch_size = batch_size
+
+    def work(self):
+        """
+        Look for analyses in the given session and run function on a batch of them
+        if any are found, managing status appropriately. Return True iff some Analyses were processed (successfully or not)
+        """
+        # start a new session for each batch
+        session = Session()
+        try:
+            # Get a batch of analyses
+            # ... and lock them for updates, skipping those already claimed by other workers
+            # ... that meet the conditions specified in the filter function
+            # ... sort by updated date
+            # ... pick the first (oldest)
+            candidates = self.filter_function(session.query(Analysis)) \
+                .with_for_update(skip_locked=True) \
+                .order_by(Analysis.updated) \
+                .limit(self.batch_size) \
+                .all()
+            if len(candidates) == 0:
+                return False  # no work to be done
+            # claim them all in the transaction holding the locks, so that no other
+            # worker can claim any of them in between
+            statuses = {}
+            for analysis in candidates:
+                statuses[analysis] = analysis.status
+                analysis.add_new_version(self.working_status)
+            session.commit()
+            analyses = candidates
+            logger.info("Worker {} claimed {} Analyses".format(os.getpid(), len(analyses)))
+        finally:
+            # make sure to release a FOR UPDATE lock, if we got one
+            session.rollback()
+
+        start = time.time()
+        try:
+            # set a timeout so if this worker stalls, we recover
+            signal.alarm(self.timeout_seconds)
+            # actually run the work function on this batch
+            failures = self.function(analyses) or {}
+        except Exception as e:
+            logger.warning("Worker {} failed to process batch".format(os.getpid()), exc_info=e)
+            session.rollback()
+            failures = {analysis: e for analysis in analyses}
+        finally:
+            # clear the timeout
+            signal.alarm(0)
+        delta = (time.time() - start) / len(analyses)
+        try:
+            for analysis in analyses:
+                if analysis in failures:
+                    logger.warning(
+                        "Worker {} failed to process Analysis {} {} -> {}".format(
+                            os.getpid(), analysis.gkg_id, statuses[analysis], self.failure_status
+                        ),
+                        exc_info=failures[analysis],
+                    )
+                    analysis.error_msg = str(failures[analysis])
+                    analysis.processing_time = delta
+                    analysis.create_new_version(self.failure_status)
+                else:
+                    success_status = self.success_status
+                    if callable(success_status):
+                        success_status = success_status(analysis)
+                    logger.info("Worker {} processed Analysis {} {} -> {} {}s".format(
+                        os.getpid(), analysis.gkg_id, statuses[analysis], success_status, delta))
+                    analysis.error_msg = None
+                    analysis.processing_time = delta
+                    analysis.create_new_version(success_status)
+        finally:
+            session.rollback()
+            session.close()
+        return True
+
+
+class LocationWorker(Worker):
+    def __init__(self, enqueue_function, function, engine, max_sleep=60, timeout_seconds=300):
+        """
+        Create a Worker that takes pending Locations off the location queue one at a time, marks them as
+        GEOCODING and runs a function on the Location. The queue entry ends up GEOCODED if the function
+        returns without an exception, and FAILED otherwise. When the queue is empty, enqueue_function is
+        called with a session to add new Locations to it; it returns the number of Locations added.
+        """
+        self.enqueue_function = enqueue_function
+        self.function = function
+        self.engine = engine
+        self.terminated = False
+        self.max_sleep = max_sleep
+        self.timeout_seconds = timeout_seconds
+        signal.signal(signal.SIGINT, self.terminate)
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGALRM, self.timeout)
+
+    def work(self):
+        """
+        Geocode the oldest pending Location, or fill the queue if there is none.
+        Return True iff a Location was processed or added to the queue
+        """
+        # start a new session for each job
+        session = Session()
+        try:
+            # Get a queued location
+            # ... and lock it for updates, skipping those already claimed by other workers
+            # ... pick the first (oldest)
+            entry = session.query(LocationQueue) \
+                .filter(LocationQueue.status == LocationStatus.PENDING) \
+                .with_for_update(skip_locked=True) \
+                .order_by(LocationQueue.updated) \
+                .first()
+            if entry is None:
+                enqueued = self.enqueue_function(session)
+                if enqueued:
+                    logger.info("Worker {} queued {} Locations".format(os.getpid(), enqueued))
+                return enqueued > 0
+            entry.status = LocationStatus.GEOCODING
+            entry.attempts += 1
+            session.commit()
+            location = entry.location
+            logger.info("Worker {} claimed Location {} '{}'".format(os.getpid(), location.id, location.location_name))
+
+            start = time.time()
+            try:
+                # set a timeout so if this worker stalls, we recover
+                signal.alarm(self.timeout_seconds)
+                self.function(location)
+                entry.status = LocationStatus.GEOCODED
+                entry.error_msg = None
+                logger.info("Worker {} geocoded Location {} {}s".format(os.getpid(), location.id, time.time() - start))
+            except Exception as e:
+                logger.warning("Worker {} failed to geocode Location {}".format(os.getpid(), location.id), exc_info=e)
+                session.rollback()
+                entry.status = LocationStatus.FAILED
+                entry.error_msg = str(e)
+            finally:
+                # clear the timeout
+                signal.alarm(0)
+            session.commit()
+        finally:
+            # make sure to release a FOR UPDATE lock, if we got one
+            session.rollback()
+            session.close()
+        return True
+
+
 class Initiator(Worker):
     def __init__(self, engine, max_sleep=60):
         """
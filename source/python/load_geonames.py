@@ -0,0 +1,20 @@
+import click
+
+from idetect.configs import get_logger
+from idetect.local_geocoder import build_index
+
+logger = get_logger(__name__)
+
+
+@click.command()
+@click.argument('dump', type=click.Path(exists=True, dir_okay=False))
+@click.argument('index', type=click.Path(dir_okay=False))
+@click.option('--min-population', default=0, help='Leave out places with a smaller population')
+def run(dump, index, min_population):
+    """Build the local geocoder INDEX from the GeoNames DUMP (e.g. allCountries.txt)"""
+    count = build_index(dump, index, min_population)
+    logger.info("Indexed {} places in {}".format(count, index))
+
+
+if __name__ == '__main__':
+    run()
@@ -13,6 +13,7 @@ from idetect.scraper import scrape
 from idetect.classifier import classify
 from idetect.fact_extractor import extract_facts
 from idetect.geotagger import process_locations
+from idetect.inference import INFERENCE_SOCKET, remote_models
 # from idetect.nlp_models.category import * 
 # from idetect.nlp_models.relevance import * 
 # from idetect.nlp_models.base_model import CustomSklLsiModel
@@ -28,18 +29,32 @@ app.secret_key = 'my unobvious secret key'
 engine = create_engine(db_url())
 Session.configure(bind=engine)
 
+remote = None
+def get_remote_models():
+    # One client, shared by both models and all the request threads
+    global remote
+    if remote is None:
+        remote = remote_models(INFERENCE_SOCKET)
+    return remote
+
 c_m = None
 def get_c_m():
     global c_m 
     if c_m is None:
-        c_m = CategoryModel()
+        if INFERENCE_SOCKET:
+            c_m, _ = get_remote_models()
+        else:
+            c_m = CategoryModel()
     return c_m
 
 r_m = None
 def get_r_m():
     global r_m
     if r_m is None:
-        r_m = RelevanceModel()
+        if INFERENCE_SOCKET:
+            _, r_m = get_remote_models()
+        else:
+            r_m = RelevanceModel()
     return r_m
 
     
@@ -252,8 +267,9 @@ def analyse_url():
         status='url added to IDETECT DB'
         try:
             work(session,analysis,Status.SCRAPING,Status.SCRAPED,Status.SCRAPING_FAILED,scrape)
-            # TODO add classification, missing modules
-            # work(session,analysis,Status.CLASSIFYING,Status.CLASSIFIED,Status.CLASSIFYING_FAILED,lambda article: classify(article, get_c_m(), get_r_m()))
+            # TODO add classification without the inference service, missing modules
+            if INFERENCE_SOCKET:
+                work(session,analysis,Status.CLASSIFYING,Status.CLASSIFIED,Status.CLASSIFYING_FAILED,lambda article: classify(article, get_c_m(), get_r_m()))
             work(session,analysis,Status.EXTRACTING,Status.EXTRACTED,Status.EXTRACTING_FAILED,extract_facts)
             work(session,analysis,Status.GEOTAGGING,Status.GEOTAGGED,Status.GEOTAGGING_FAILED,process_locations)
         except Exception as e:
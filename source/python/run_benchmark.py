@@ -0,0 +1,116 @@
+import time
+
+import click
+
+from idetect.configs import get_logger
+from idetect.fact_extractor import PROFILED_METHODS
+from idetect.interpreter import Interpreter
+from idetect.language import get_nlp
+from idetect.load_data import DEFAULT_KEYWORDS
+from idetect.profiling import Profiler
+from idetect.tests.articles import ARTICLES
+
+logger = get_logger(__name__)
+
+# A clause repeated to make the long run-on "sentences" often found in PDFs
+CLAUSE = "floods in Kerala and Tamil Nadu displaced more than 500 people from villages near Chennai"
+
+# Articles of the fact extractor tests, a multi-country one and a long run-on one
+EXTRACTION_CORPUS = ARTICLES + [
+    "Heavy rain across India and Pakistan destroyed 300 homes and left more than 2000 families homeless",
+    " ".join([CLAUSE] * 5),
+]
+
+
+def legacy_contains_token(token, collection):
+    for c in collection:
+        if token.i == c.i:
+            return True
+    return False
+
+
+def legacy_get_descendents(sentence, root):
+    return [t for t in sentence if root.is_ancestor_of(t)]
+
+
+def legacy_get_contiguous_tokens(token_list):
+    ancestors = [set(t.ancestors) for t in token_list]
+    common_ancestor_tokens = ancestors[0].intersection(*ancestors) if ancestors else []
+    highest_contiguous_block = []
+    for toke in token_list:
+        if legacy_contains_token(toke.head, common_ancestor_tokens):
+            highest_contiguous_block.append(toke)
+    added_tokens = 1
+    while added_tokens > 0:
+        added_tokens = 0
+        for toke in token_list:
+            if legacy_contains_token(toke.head, highest_contiguous_block):
+                if not legacy_contains_token(toke, highest_contiguous_block):
+                    highest_contiguous_block.append(toke)
+                    added_tokens += 1
+    return highest_contiguous_block
+
+
+def timed(function, *args, repeat=3):
+    """Return the result of function and the best time of repeat runs"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        delta = time.time() - start
+        best = delta if best is None else min(best, delta)
+    return result, best
+
+
+@click.group()
+def run():
+    pass
+
+
+@run.command()
+@click.option('--lengths', default='10,50,100', help='Comma separated numbers of clauses per sentence')
+def trees(lengths):
+    """Compare the parse tree algorithms of the Interpreter with their previous versions"""
+    nlp = get_nlp('extraction')
+    interpreter = Interpreter(None, nlp, keywords={})
+    for n in [int(l) for l in lengths.split(',')]:
+        doc = nlp(', while '.join([CLAUSE] * n))
+        sentence = doc[:]
+        root = sentence.root
+        locations = [t for e in doc.ents if e.label_ == 'GPE' for t in e]
+
+        old, old_time = timed(legacy_get_descendents, sentence, root)
+        new, new_time = timed(interpreter.get_descendents, sentence, root)
+        assert [t.i for t in old] == [t.i for t in new]
+        logger.info("{} tokens, get_descendents: {:.4f}s -> {:.4f}s".format(len(doc), old_time, new_time))
+
+        old, old_time = timed(legacy_get_contiguous_tokens, locations)
+        new, new_time = timed(interpreter.get_contiguous_tokens, locations)
+        assert [t.i for t in old] == [t.i for t in new]
+        logger.info("{} tokens, get_contiguous_tokens: {:.4f}s -> {:.4f}s".format(len(doc), old_time, new_time))
+
+
+@run.command()
+@click.option('--repeat', default=10, help='Number of passes over the corpus')
+def extraction(repeat):
+    """Run the extraction corpus through the Interpreter and report where the time goes"""
+    nlp = get_nlp('extraction')
+    interpreter = Interpreter(None, nlp, keywords=DEFAULT_KEYWORDS)
+    profiler = Profiler()
+    profiler.wrap(interpreter, PROFILED_METHODS)
+    parse = profiler.timed('parse', nlp)
+    reports = 0
+    start = time.time()
+    for i in range(repeat):
+        for text in EXTRACTION_CORPUS:
+            profiler.start_article()
+            reports += len(interpreter.process_article_new(parse(text)))
+            profiler.end_article()
+    delta = time.time() - start
+    logger.info("{} articles, {} reports in {:.2f}s: {:.1f} articles/s".format(
+        profiler.articles, reports, delta, profiler.articles / delta))
+    logger.info("Breakdown: {}".format(profiler.report()))
+
+
+if __name__ == '__main__':
+    run()
@@ -1,8 +1,10 @@
 import click
 
-from idetect.configs import Command
-from idetect.classifier import classify
-from idetect.model import Status, Analysis
+from idetect.configs import Command, get_logger
+from idetect.classifier import classify, classified_status, model_version, purge_classification_cache
+from idetect.inference import INFERENCE_SOCKET, InferenceException, remote_models
+from idetect.model import Session, Status, Analysis
+from idetect.prefilter import LexiconPrefilter, USE_RELEVANCE_PREFILTER
 
 from idetect.nlp_models.category import CategoryModel
 from idetect.nlp_models.relevance import RelevanceModel
@@ -10,20 +12,40 @@ from idetect.nlp_models.relevance import RelevanceModel
 from idetect.nlp_models.category import *  # noqa: F403 F401
 from idetect.nlp_models.relevance import *  # noqa: F403 F401
 
+logger = get_logger(__name__)
+
 
 @click.command()
 @click.option('--single-run', is_flag=True, help='non indefinitely mode (Only process current data)')
 def run(single_run):
-    c_m = CategoryModel()
-    r_m = RelevanceModel()
-    Command(
+    if INFERENCE_SOCKET:
+        # Models are held by the local inference service
+        c_m, r_m = remote_models(INFERENCE_SOCKET)
+    else:
+        c_m = CategoryModel()
+        r_m = RelevanceModel()
+    prefilter = None
+    command = Command(
         __file__,
         [
             lambda query: query.filter(Analysis.status == Status.SCRAPED), Status.CLASSIFYING,
-            Status.CLASSIFIED, Status.CLASSIFYING_FAILED,
-            lambda article: classify(article, c_m, r_m)
+            classified_status, Status.CLASSIFYING_FAILED,
+            lambda article: classify(article, c_m, r_m, prefilter)
         ],
-    ).run(is_single_run=single_run)
+    )
+
+    session = Session()
+    # Cached results of previously deployed models are deleted once they are old enough
+    try:
+        purge_classification_cache(session, model_version(c_m, r_m))
+    except InferenceException as e:
+        # the inference service may not be up yet; the next start purges instead
+        logger.warning("Skipped purging the classification cache: {}".format(e))
+    if USE_RELEVANCE_PREFILTER:
+        prefilter = LexiconPrefilter.from_session(session)
+    session.close()
+
+    command.run(is_single_run=single_run)
 
 
 if __name__ == '__main__':
@@ -1,22 +1,38 @@
 import click
 
 from idetect.configs import Command
-from idetect.fact_extractor import extract_facts
+from idetect.fact_extractor import extract_facts, extract_facts_batch, warm_location_cache
 from idetect.load_data import load_countries, load_terms
 from idetect.model import Session, Status, Analysis, Country, FactKeyword
+from idetect.parse_cache import STORE_PARSES, purge_document_parses
+from idetect.worker import BatchWorker
 
 
 @click.command()
 @click.option('--single-run', is_flag=True, help='non indefinitely mode (Only process current data)')
-def run(single_run):
-    command = Command(
-        __file__,
-        [
-            lambda query: query.filter(Analysis.status == Status.CLASSIFIED),
-            Status.EXTRACTING, Status.EXTRACTED, Status.EXTRACTING_FAILED,
-            extract_facts
-        ],
-    )
+@click.option('--batch-size', default=1, help='Number of analyses claimed and parsed together')
+@click.option('--n-threads', default=1, help='Number of threads used to parse a batch')
+def run(single_run, batch_size, n_threads):
+    if batch_size > 1:
+        command = Command(
+            __file__,
+            [
+                lambda query: query.filter(Analysis.status == Status.CLASSIFIED),
+                Status.EXTRACTING, Status.EXTRACTED, Status.EXTRACTING_FAILED,
+                lambda analyses: extract_facts_batch(analyses, batch_size, n_threads)
+            ],
+            kwargs={'batch_size': batch_size},
+            worker_class=BatchWorker,
+        )
+    else:
+        command = Command(
+            __file__,
+            [
+                lambda query: query.filter(Analysis.status == Status.CLASSIFIED),
+                Status.EXTRACTING, Status.EXTRACTED, Status.EXTRACTING_FAILED,
+                extract_facts
+            ],
+        )
 
     # Check necessary data exists prior to fact extraction
     session = Session()
@@ -29,6 +45,13 @@ def run(single_run):
     keywords = session.query(FactKeyword).all()
     if len(keywords) == 0:
         load_terms(session)
+
+    # Most location names are found again and again
+    warm_location_cache(session)
+
+    if STORE_PARSES:
+        # Stored parses are only reused when the same content is extracted again
+        purge_document_parses(session)
     session.close()
 
     command.run(is_single_run=single_run)
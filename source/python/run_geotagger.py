@@ -1,21 +1,46 @@
 import click
 
 from idetect.configs import Command
-from idetect.geotagger import process_locations
-from idetect.model import Status, Analysis
+from idetect.geocode_cache import purge_geocode_cache
+from idetect.geotagger import process_locations, process_locations_batch, locations_geocoded, USE_LOCATION_QUEUE
+from idetect.model import Session, Status, Analysis
+from idetect.worker import BatchWorker
 
 
 @click.command()
 @click.option('--single-run', is_flag=True, help='non indefinitely mode (Only process current data)')
-def run(single_run):
-    Command(
-        __file__,
-        [
-            lambda query: query.filter(Analysis.status == Status.EXTRACTED),
-            Status.GEOTAGGING, Status.GEOTAGGED, Status.GEOTAGGING_FAILED,
-            process_locations
-        ],
-    ).run(is_single_run=single_run)
+@click.option('--batch-size', default=1, help='Number of analyses claimed and geotagged together')
+def run(single_run, batch_size):
+    # with the location queue, wait until run_location_geocoder has geocoded the locations
+    filter_function = locations_geocoded if USE_LOCATION_QUEUE \
+        else lambda query: query.filter(Analysis.status == Status.EXTRACTED)
+    if batch_size > 1:
+        command = Command(
+            __file__,
+            [
+                filter_function,
+                Status.GEOTAGGING, Status.GEOTAGGED, Status.GEOTAGGING_FAILED,
+                process_locations_batch
+            ],
+            kwargs={'batch_size': batch_size},
+            worker_class=BatchWorker,
+        )
+    else:
+        command = Command(
+            __file__,
+            [
+                filter_function,
+                Status.GEOTAGGING, Status.GEOTAGGED, Status.GEOTAGGING_FAILED,
+                process_locations
+            ],
+        )
+
+    session = Session()
+    # Expired geocoding results would only be looked up to be ignored
+    purge_geocode_cache(session)
+    session.close()
+
+    command.run(is_single_run=single_run)
 
 
 if __name__ == '__main__':
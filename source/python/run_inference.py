@@ -0,0 +1,31 @@
+import click
+
+from idetect.configs import get_logger
+from idetect.inference import InferenceServer, INFERENCE_SOCKET, DEFAULT_SOCKET
+
+from idetect.nlp_models.category import CategoryModel
+from idetect.nlp_models.relevance import RelevanceModel
+# NOTE: Throws error is not provided for pickle
+from idetect.nlp_models.category import *  # noqa: F403 F401
+from idetect.nlp_models.relevance import *  # noqa: F403 F401
+
+logger = get_logger(__name__)
+
+
+@click.command()
+@click.option('--socket', 'socket_path', default=INFERENCE_SOCKET or DEFAULT_SOCKET,
+              help='Unix socket to listen on')
+@click.option('--batch-window', default=0.02, help='Seconds to wait for more requests before predicting a batch')
+@click.option('--max-batch', default=32, help='Maximum number of texts predicted together')
+def run(socket_path, batch_window, max_batch):
+    models = {
+        'category': CategoryModel(),
+        'relevance': RelevanceModel(),
+    }
+    server = InferenceServer(socket_path, models, batch_window=batch_window, max_batch=max_batch)
+    logger.info(f"Serving inference on {socket_path}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    run()
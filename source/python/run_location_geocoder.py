@@ -0,0 +1,19 @@
+import click
+
+from idetect.configs import Command
+from idetect.geotagger import enqueue_locations, geocode_location
+from idetect.worker import LocationWorker
+
+
+@click.command()
+@click.option('--single-run', is_flag=True, help='non indefinitely mode (Only process current data)')
+def run(single_run):
+    Command(
+        __file__,
+        [enqueue_locations, geocode_location],
+        worker_class=LocationWorker,
+    ).run(is_single_run=single_run)
+
+
+if __name__ == '__main__':
+    run()